@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import copy
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from models.lvt import LVT, load_checkpoint
+
+'''
+Throughput and parity of the bfloat16 autocast and channels_last modes (--bf16, --channels_last) on cpu.
+For every mode, it reports the training step and evaluation throughput on random images,
+and the difference of the logits to float32 (max abs diff, argmax agreement).
+With --checkpoint and --datapath, the test accuracy of the checkpoint on CIFAR-100 is also compared.
+usage : python benchmarks/bf16_channels_last.py [--batch 32] [--size 32] [--checkpoint ckpt/best_models/task_cifar100_task_9.pt --datapath /data/cifar100]
+'''
+MODES = [('fp32', False, False), ('channels_last', False, True), ('bf16', True, False), ('bf16 + channels_last', True, True)]
+
+# same as Trainer.forward_features
+def features(model, x, bf16, channels_last):
+    with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+        if channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        out = model.forward_backbone(x)
+    return out.float()
+
+def prepare(model, channels_last):
+    model = copy.deepcopy(model)
+    if channels_last:
+        model.backbone.to(memory_format=torch.channels_last)
+    return model
+
+def throughput(fn, batch, n_iter):
+    for _ in range(3):
+        fn()
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        fn()
+    return batch * n_iter / (time.perf_counter() - start)
+
+def train_throughput(model, x, y, bf16, channels_last, n_iter):
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    cross_entropy = nn.CrossEntropyLoss()
+    def step():
+        feature = features(model, x, bf16, channels_last)
+        loss = cross_entropy(model.forward_inj(feature), y) + cross_entropy(model.forward_acc(feature), y)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return throughput(step, x.shape[0], n_iter)
+
+def eval_throughput(model, x, bf16, channels_last, n_iter):
+    model.eval()
+    with torch.no_grad():
+        return throughput(lambda: model.forward_acc(features(model, x, bf16, channels_last)), x.shape[0], n_iter)
+
+'''Task IL test accuracy of a checkpoint on the tasks seen so far, as in Trainer.eval'''
+def test_accuracy(model, task, datapath, bf16, channels_last):
+    from utils import IncrementalDataLoader, get_transforms
+    batch = model.arch['batch'] if model.arch['batch'] > 1 else 100
+    increment = 100 // 10
+    data_loader = IncrementalDataLoader('cifar100', datapath, False, 10, range(task+1), batch, get_transforms('cifar100', True), drop_last=False)
+    correct, total = 0, 0
+    model.eval()
+    with torch.no_grad():
+        for x, y, t in data_loader:
+            n_samples = x.shape[0]
+            if n_samples < batch:
+                x = torch.concat([x, torch.zeros((batch - n_samples, *x.shape[1:]))])
+            feature = features(model, x, bf16, channels_last)[:n_samples]
+            predicted = model.forward_acc_multi(feature, t).argmax(1)
+            correct += (predicted == y % increment).sum().item()
+            total += n_samples
+    return 100 * correct / total
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type = int, default = 32, help = 'batch size')
+    parser.add_argument('--size', type = int, default = 32, help = 'image size')
+    parser.add_argument('--num_head', type = int, default = 4, help = 'number of attention head')
+    parser.add_argument('--hidden_dim', type = int, default = 512, help = 'number of hidden dimension of attention')
+    parser.add_argument('--n_iter', type = int, default = 10, help = 'number of timed iterations')
+    parser.add_argument('--checkpoint', type = str, default = None, help = 'Task IL checkpoint of CIFAR-100 for the accuracy parity')
+    parser.add_argument('--datapath', type = str, default = None, help = 'CIFAR-100 data path')
+    args, _ = parser.parse_known_args()
+
+    torch.manual_seed(1234)
+    device = torch.device('cpu')
+    model = LVT(batch=args.batch, n_class=10, IL_type='task', dim=512, num_heads=args.num_head,
+                hidden_dim=args.hidden_dim, bias=True, device=device, pretrained=False)
+    x = torch.randn(args.batch, 3, args.size, args.size)
+    y = torch.randint(0, 10, (args.batch,))
+
+    model.eval()
+    with torch.no_grad():
+        reference = model.forward_acc(features(model, x, False, False))
+
+    base_train, base_eval = None, None
+    for name, bf16, channels_last in MODES:
+        m = prepare(model, channels_last).eval()
+        with torch.no_grad():
+            logits = m.forward_acc(features(m, x, bf16, channels_last))
+        diff = (logits - reference).abs().max().item()
+        agree = (logits.argmax(1) == reference.argmax(1)).float().mean().item() * 100
+        train = train_throughput(prepare(model, channels_last), x, y, bf16, channels_last, args.n_iter)
+        evaluation = eval_throughput(m, x, bf16, channels_last, args.n_iter)
+        base_train, base_eval = base_train or train, base_eval or evaluation
+        print(f'{name:<21}| train : {train:8.1f} images/s ({train/base_train:.2f}x) | eval : {evaluation:8.1f} images/s ({evaluation/base_eval:.2f}x) '
+              f'| max abs diff : {diff:.3e} | argmax agreement : {agree:.1f}%')
+
+    if args.checkpoint is not None and args.datapath is not None:
+        checkpoint, meta = load_checkpoint(args.checkpoint, device)
+        if meta is None:
+            raise ValueError('a checkpoint of the state_dict format (save_checkpoint) is required')
+        task = meta['task']
+        for name, bf16, channels_last in MODES:
+            acc = test_accuracy(prepare(checkpoint, channels_last), task, args.datapath, bf16, channels_last)
+            print(f'{name:<21}| test accuracy on tasks 0 ~ {task} : {acc:.2f}')
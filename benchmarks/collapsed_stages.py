@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from models.lvt import LVT, CollapsedStages, check_collapsed, COLLAPSED_TOL
+
+'''
+Per-batch latency of the LVT transformer stages (stage1 ~ stage3, shrink1, shrink2)
+against the collapsed pure matmul path, on random pooled backbone features.
+It also reports the maximum absolute difference between the two outputs, which has to be below COLLAPSED_TOL.
+usage : python benchmarks/collapsed_stages.py [--batch 32] [--num_head 4] [--shared_key]
+'''
+def latency(fn, x, n_iter):
+    with torch.no_grad():
+        for _ in range(3):
+            fn(x)
+        start = time.perf_counter()
+        for _ in range(n_iter):
+            fn(x)
+    return (time.perf_counter() - start) / n_iter * 1000.
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type = int, default = 32, help = 'batch size')
+    parser.add_argument('--num_head', type = int, default = 4, help = 'number of attention head')
+    parser.add_argument('--hidden_dim', type = int, default = 512, help = 'number of hidden dimension of attention')
+    parser.add_argument('--shared_key', action = 'store_true', default = False, help = 'batch-agnostic attention key')
+    parser.add_argument('--n_iter', type = int, default = 20, help = 'number of timed iterations')
+    args, _ = parser.parse_known_args()
+
+    device = torch.device('cpu')
+    model = LVT(batch=1 if args.shared_key else args.batch, n_class=10, IL_type='task', dim=512, num_heads=args.num_head,
+                hidden_dim=args.hidden_dim, bias=True, device=device, pretrained=False)
+    # random statistics, so that folding the BatchNorm is actually tested
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 1.5)
+    model.eval()
+    stages = CollapsedStages(model)
+
+    x = torch.randn(args.batch, 512, 1, 1)
+    print(f'max abs diff : {check_collapsed(model, stages, x, COLLAPSED_TOL):.3e}')
+    eager = latency(model.forward_stages, x, args.n_iter)
+    collapsed = latency(stages, x, args.n_iter)
+    print(f'stages    : {eager:.2f} ms / batch')
+    print(f'collapsed : {collapsed:.2f} ms / batch ({eager/collapsed:.2f}x)')
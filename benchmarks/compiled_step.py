@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from models.lvt import LVT
+from trainer import current_losses, attention_loss
+from utils import CompiledFunction
+
+'''
+Cold and warm latency of the training step of Trainer.train in eager and compiled mode (--compile).
+    cold       : first step, which includes the compilation
+    warm       : median of the next steps
+    add_classes: first step after the classifiers are extended (Class IL), which should not recompile the features
+usage : python benchmarks/compiled_step.py [--batch 32] [--size 32] [--n_iter 20]
+'''
+def features(model, x):
+    return model.forward_backbone(x)
+
+def make_step(model, x, y, compiled):
+    forward = CompiledFunction(features, 'features') if compiled else features
+    losses = CompiledFunction(current_losses, 'current_losses', dynamic=True) if compiled else current_losses
+    attention = CompiledFunction(attention_loss, 'attention_loss') if compiled else attention_loss
+    K_grad, K_prev = torch.rand_like(model.get_K()), model.get_K().detach().clone()
+    bias_grad, bias_prev = torch.rand_like(model.get_bias()), model.get_bias().detach().clone()
+    state = {}
+
+    def reset():
+        state['optimizer'] = torch.optim.SGD(model.parameters(), lr=0.01)
+
+    def step():
+        feature = forward(model, x)
+        _, _, L_It, L_At = losses(feature, y, model.inj_clf.weight, model.inj_clf.bias, model.acc_clf.weight, model.acc_clf.bias)
+        loss = L_It + L_At + 0.5 * attention(model, K_grad, K_prev, bias_grad, bias_prev)
+        state['optimizer'].zero_grad()
+        loss.backward()
+        nn.utils.clip_grad_norm_(model.parameters(), 5.)
+        state['optimizer'].step()
+
+    reset()
+    return step, reset
+
+def latency(step):
+    start = time.perf_counter()
+    step()
+    return (time.perf_counter() - start) * 1000.
+
+def measure(model, x, y, compiled, n_iter):
+    step, reset = make_step(model, x, y, compiled)
+    cold = latency(step)
+    warm = sorted(latency(step) for _ in range(n_iter))[n_iter // 2]
+    model.add_classes(10)
+    reset()
+    after = latency(step)
+    return cold, warm, after
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type = int, default = 32, help = 'batch size')
+    parser.add_argument('--size', type = int, default = 32, help = 'image size')
+    parser.add_argument('--num_head', type = int, default = 4, help = 'number of attention head')
+    parser.add_argument('--hidden_dim', type = int, default = 512, help = 'number of hidden dimension of attention')
+    parser.add_argument('--n_iter', type = int, default = 20, help = 'number of warm iterations')
+    args, _ = parser.parse_known_args()
+
+    x = torch.randn(args.batch, 3, args.size, args.size)
+    y = torch.randint(0, 10, (args.batch,))
+    for compiled in [False, True]:
+        torch.manual_seed(1234)
+        model = LVT(batch=args.batch, n_class=10, IL_type='class', dim=512, num_heads=args.num_head,
+                    hidden_dim=args.hidden_dim, bias=True, device=torch.device('cpu'), pretrained=False).train()
+        cold, warm, after = measure(model, x, y, compiled, args.n_iter)
+        print(f"{'compiled' if compiled else 'eager':<9}| cold : {cold:9.1f} ms | warm : {warm:7.1f} ms | add_classes : {after:9.1f} ms")
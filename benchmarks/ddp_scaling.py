@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import datetime
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from models.lvt import LVT, shard_attention
+from utils import all_reduce_grads, average_buffers
+
+'''
+Training throughput of the data-parallel mode on cpu (gloo) for 1, 2, 4 and 8 processes.
+Each process runs the training step of Trainer.train (backbone, both classifiers,
+flattened gradient all-reduce, SGD) on its share of a fixed global batch of random images,
+and the cpu cores are divided between the processes.
+usage : python benchmarks/ddp_scaling.py [--batch 32] [--size 32] [--world_sizes 1 2 4 8] [--shared_key]
+'''
+def worker(rank, world_size, args, port, results):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size,
+                            timeout=datetime.timedelta(minutes=10))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    torch.manual_seed(1234)
+
+    model = LVT(batch=1 if args.shared_key else args.batch, n_class=10, IL_type='task', dim=512, num_heads=args.num_head,
+                hidden_dim=args.hidden_dim, bias=True, device=torch.device('cpu'), pretrained=False)
+    if world_size > 1:
+        shard_attention(model, rank, world_size)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    cross_entropy = nn.CrossEntropyLoss()
+
+    local_batch = args.batch // world_size
+    x = torch.randn(local_batch, 3, args.size, args.size)
+    y = torch.randint(0, 10, (local_batch,))
+
+    def step():
+        feature = model.forward_backbone(x)
+        loss = cross_entropy(model.forward_inj(feature), y) + cross_entropy(model.forward_acc(feature), y)
+        optimizer.zero_grad()
+        loss.backward()
+        if world_size > 1:
+            all_reduce_grads(model)
+        nn.utils.clip_grad_norm_(model.parameters(), 5.)
+        optimizer.step()
+
+    for _ in range(args.n_warmup):
+        step()
+    if world_size > 1:
+        dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.n_iter):
+        step()
+    if world_size > 1:
+        average_buffers(model)
+        dist.barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        results.put(elapsed)
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type = int, default = 32, help = 'global batch size')
+    parser.add_argument('--size', type = int, default = 32, help = 'image size')
+    parser.add_argument('--num_head', type = int, default = 4, help = 'number of attention head')
+    parser.add_argument('--hidden_dim', type = int, default = 512, help = 'number of hidden dimension of attention')
+    parser.add_argument('--shared_key', action = 'store_true', default = False, help = 'batch-agnostic attention key')
+    parser.add_argument('--world_sizes', type = int, nargs = '+', default = [1, 2, 4, 8], help = 'numbers of processes')
+    parser.add_argument('--n_warmup', type = int, default = 3, help = 'number of untimed iterations')
+    parser.add_argument('--n_iter', type = int, default = 20, help = 'number of timed iterations')
+    parser.add_argument('--port', type = int, default = 29600, help = 'first port of the process groups')
+    args, _ = parser.parse_known_args()
+
+    results = mp.get_context('spawn').SimpleQueue()
+    base = None
+    for i, world_size in enumerate(args.world_sizes):
+        if args.batch % world_size != 0:
+            print(f'{world_size} processes : skipped, batch {args.batch} is not divisible')
+            continue
+        mp.spawn(worker, args=(world_size, args, args.port + i, results), nprocs=world_size)
+        throughput = args.batch * args.n_iter / results.get()
+        if base is None:
+            base, base_size = throughput, world_size
+        speedup = throughput / base
+        print(f'{world_size} processes : {throughput:.1f} images/s ({speedup:.2f}x, efficiency {speedup*base_size/world_size*100:.0f}%)')
@@ -0,0 +1,76 @@
+import os
+import sys
+import resource
+import subprocess
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils import MemoryDataset, get_normalization
+
+'''
+Peak RSS of MemoryDataset.remove_examplars at a task boundary.
+Each case runs in a fresh process, because ru_maxrss is the peak of the whole process.
+    copy    : the previous implementation, which built four new zeros_like buffers
+    inplace : the current in-place compaction
+usage : python benchmarks/memory_compaction.py [--dataset imagenet100]
+'''
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def remove_examplars_copy(memory, new_k):
+    new_x = torch.zeros_like(memory.x)
+    new_y = torch.zeros_like(memory.y)
+    new_t = torch.zeros_like(memory.t)
+    new_z = torch.zeros_like(memory.z)
+    for i, start in enumerate(range(0, memory.size, memory.k)):
+        if start+new_k > memory.size:
+            break
+        new_x[new_k*i:new_k*(i+1)] = memory.x[start:start+new_k]
+        new_y[new_k*i:new_k*(i+1)] = memory.y[start:start+new_k]
+        new_t[new_k*i:new_k*(i+1)] = memory.t[start:start+new_k]
+        new_z[new_k*i:new_k*(i+1)] = memory.z[start:start+new_k]
+    memory.x, memory.y, memory.t, memory.z, memory.k = new_x, new_y, new_t, new_z, new_k
+
+def run_case(dataset, memory_size, mode, increment=10):
+    size = 32 if dataset == 'cifar100' else 224
+    mean, std = get_normalization(dataset)
+    # state after task 0 : 10 classes with memory_size // 10 examplars each
+    k = memory_size // increment
+    memory = MemoryDataset(
+        torch.randint(0, 256, (memory_size, 3, size, size), dtype=torch.uint8),
+        torch.randint(0, 10, (memory_size,), dtype=torch.int16),
+        torch.zeros(memory_size, dtype=torch.int8),
+        torch.randn(memory_size, increment),
+        k, mean, std
+    )
+    before = peak_rss_mb()
+    if mode == 'copy':
+        remove_examplars_copy(memory, memory_size // (increment*2))
+    else:
+        memory.remove_examplars(memory_size // (increment*2))
+    after = peak_rss_mb()
+    print(f'{before:.1f} {after:.1f}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type = str, default = 'imagenet100', help = 'cifar100, tinyimagenet200, imagenet100')
+    parser.add_argument('--case', type = str, default = None, help = 'internal : memory_size,mode')
+    args, _ = parser.parse_known_args()
+
+    if args.case is not None:
+        memory_size, mode = args.case.split(',')
+        run_case(args.dataset, int(memory_size), mode)
+    else:
+        print(f'{"memory_size":>12} {"mode":>8} {"buffer (MB)":>12} {"peak before (MB)":>17} {"peak after (MB)":>16} {"increase (MB)":>14}')
+        for memory_size in [500, 2000, 5000]:
+            for mode in ['copy', 'inplace']:
+                out = subprocess.run([sys.executable, __file__, '--dataset', args.dataset, '--case', f'{memory_size},{mode}'],
+                                     capture_output=True, text=True, check=True).stdout.split()
+                before, after = float(out[0]), float(out[1])
+                size = 32 if args.dataset == 'cifar100' else 224
+                buffer_mb = memory_size * 3 * size * size / 1024. / 1024.
+                print(f'{memory_size:>12} {mode:>8} {buffer_mb:>12.1f} {before:>17.1f} {after:>16.1f} {after-before:>14.1f}')
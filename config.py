@@ -5,6 +5,15 @@ def get_config(dataset = 'cifar100'):
     ## GLOBAL
     config = edict()
 
+    ## DATA PIPELINE
+    config.num_workers = 2
+    config.prefetch_factor = 2
+    config.persistent_workers = True
+    config.pin_memory = True
+
+    ## RESUME
+    config.ckpt_interval = 0    # epochs between the training state checkpoints (0 : never)
+
     if dataset == 'cifar100':
         config.batch_size = 32
         config.epoch = 50
@@ -14,6 +23,7 @@ def get_config(dataset = 'cifar100'):
         config.scheduler = False
 
     elif dataset == 'tinyimagenet200':
+        config.num_workers = 8
         config.batch_size = 32
         config.epoch = 100
         config.lr=0.1
@@ -22,6 +32,7 @@ def get_config(dataset = 'cifar100'):
         config.scheduler = False
 
     elif dataset == 'imagenet100':
+        config.num_workers = 8
         config.batch_size = 32
         config.epoch = 100
         config.lr=0.1
@@ -4,6 +4,7 @@ from torch import nn
 from torchvision import models
 import copy
 import random
+import inspect
 import numpy as np
 
 from einops import rearrange
@@ -23,6 +24,10 @@ And they can interact with previous task
 by comparing the value of attention key and bias.
 '''
 class Attention(nn.Module):
+    '''
+    With batch=1, the key and bias are shared across the batch,
+    and the module accepts any batch size.
+    '''
     def __init__(self, batch, dim, num_heads, bias, device):
         super(Attention, self).__init__()
         self.num_heads = num_heads
@@ -38,11 +43,13 @@ class Attention(nn.Module):
         # Learnable External Key        
         self.k = nn.Parameter(torch.randn(batch, self.dim, 1, 1))
         self.bias = nn.Parameter(torch.randn(batch, self.num_heads, (self.dim//self.num_heads)**2, 1))
+        # rows of the key and bias used by this process in data-parallel training (see shard_attention)
+        self.key_rows = None
         
     def forward(self, x):
         b,c,h,w = x.shape
 
-        qv = self.to_qv(x.squeeze())
+        qv = self.to_qv(x.flatten(1))
         q,v = qv.chunk(2, dim=1)
 
         # Unsqueeze to 4 dimension
@@ -50,9 +57,20 @@ class Attention(nn.Module):
         v = v.unsqueeze(2).unsqueeze(2)
 
         q = rearrange(q, 'b (head c) h w -> b head c (h w)', head=self.num_heads)
-        k = rearrange(self.k, 'b (head c) h w -> b head c (h w)', head=self.num_heads)
+        # A key and bias of batch 1 are shared by every sample and broadcast.
+        # When several batches are concatenated (e.g. current and replay batch),
+        # the i-th sample of every batch uses the i-th key and bias.
+        k, bias = self.k, self.bias
+        key_rows = getattr(self, 'key_rows', None)     # not set in the pickled models of the previous format
+        if key_rows is not None:
+            k, bias = k[key_rows], bias[key_rows]
+        if k.shape[0] != 1 and b != k.shape[0]:
+            k = k.repeat(b // k.shape[0], 1, 1, 1)
+            bias = bias.repeat(b // bias.shape[0], 1, 1, 1)
+
+        k = rearrange(k, 'b (head c) h w -> b head c (h w)', head=self.num_heads)
         v = rearrange(v, 'b (head c) h w -> b head c (h w)', head=self.num_heads)
-        bias = self.bias.view(b, self.num_heads, self.dim//self.num_heads, self.dim//self.num_heads)
+        bias = bias.view(-1, self.num_heads, self.dim//self.num_heads, self.dim//self.num_heads)
         
         v = self.bn(v)
         
@@ -94,27 +112,29 @@ class TransformerBlock(nn.Module):
     def forward(self, input):
         out = self.bn(self.conv(self.attn(input)))
         out += input
-        out = self.ffn(out.squeeze()).unsqueeze(2).unsqueeze(2) + out
+        out = self.ffn(out.flatten(1)).unsqueeze(2).unsqueeze(2) + out
 
         return out
     
 class Backbone(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super(Backbone, self).__init__()
-        self.backbone = models.resnet18(pretrained=True)
+        self.backbone = models.resnet18(pretrained=pretrained)
         self.backbone = nn.Sequential(*list(self.backbone.children())[:-2])
         
     def forward(self, x):
         return self.backbone(x)
     
 class LVT(nn.Module):
-    def __init__(self, n_class, batch, IL_type, dim, num_heads, hidden_dim, bias, device):
+    def __init__(self, n_class, batch, IL_type, dim, num_heads, hidden_dim, bias, device, pretrained=True):
         super(LVT, self).__init__()
         self.n_class = n_class
         self.IL_type = IL_type
         self.dim = dim
         self.device = device
-        self.backbone = Backbone().eval()
+        # architecture, stored in the checkpoint
+        self.arch = dict(batch=batch, dim=dim, num_heads=num_heads, hidden_dim=hidden_dim, bias=bias)
+        self.backbone = Backbone(pretrained).eval()
         self.stage1 = nn.Sequential(*[TransformerBlock(batch=batch, dim=dim, num_heads=num_heads, hidden_dim=hidden_dim, bias=bias, device=self.device) for i in range(2)])
         self.shrink1 = nn.Conv2d(dim, dim*2, kernel_size=3, stride=2, padding=1, bias=bias)
         self.stage2 = nn.Sequential(*[TransformerBlock(batch=batch, dim=dim*2, num_heads=num_heads, hidden_dim=hidden_dim, bias=bias, device=self.device) for i in range(2)])
@@ -183,9 +203,20 @@ class LVT(nn.Module):
             self.stage3[1].attn.bias.grad
         ], dim=2)
             
-    def forward_backbone(self, input):
+    '''
+    With stages (CollapsedStages), the transformer stages run on the collapsed fast path.
+    '''
+    def forward_backbone(self, input, stages=None):
         out = self.backbone(input)
         out = F.adaptive_avg_pool2d(out, (1,1))
+        if stages is not None:
+            return stages(out)
+        return self.forward_stages(out)
+
+    '''
+    Transformer stages on the pooled (B, dim, 1, 1) backbone feature.
+    '''
+    def forward_stages(self, out):
         out = self.shrink1(self.stage1(out))
         out = self.shrink2(self.stage2(out))
         out = self.stage3(out)
@@ -193,14 +224,31 @@ class LVT(nn.Module):
         return out
         
     def forward_inj(self, input, task_id=None):
-        return self.inj_clf(input.squeeze())
+        return self.inj_clf(input.flatten(1))
         
     def forward_acc(self, input, task_id=None):
         if task_id is None:
-            return self.acc_clf(input.squeeze())
+            return self.acc_clf(input.flatten(1))
         else:
-            return self.prev_acc_clf[task_id](input.squeeze())
+            return self.prev_acc_clf[task_id](input.flatten(1))
         
+    '''
+    Stacked weights of the stored accumulation classifiers in Task IL, (n_task, n_class, dim).
+    The stored classifiers are not trained anymore, so the stack is only rebuilt after add_classes.
+    '''
+    def get_prev_acc_weight(self):
+        if getattr(self, 'prev_acc_weight', None) is None or self.prev_acc_weight.shape[0] != len(self.prev_acc_clf):
+            self.prev_acc_weight = torch.stack([clf.weight for clf in self.prev_acc_clf]).detach()
+        return self.prev_acc_weight
+
+    '''
+    Logits of each sample from the accumulation classifier of its own task,
+    computed with one batched matmul. task_ids : (B,)
+    '''
+    def forward_acc_multi(self, input, task_ids):
+        weight = self.get_prev_acc_weight()[task_ids]
+        return torch.bmm(weight, input.flatten(1).unsqueeze(2)).squeeze(2)
+
     '''
     Add classes after task.
     '''
@@ -211,10 +259,213 @@ class LVT(nn.Module):
         self.init_clf(self.inj_clf)
         if self.IL_type == 'task':
             self.prev_acc_clf.append(copy.deepcopy(self.acc_clf))
+            self.prev_acc_weight = None
         else:
             weight = self.acc_clf.weight.data.clone().detach()
             self.acc_clf = torch.nn.Linear(self.dim*4, self.n_class)
             self.init_clf(self.acc_clf)
             self.acc_clf.weight.data[:self.n_class-n_class] = weight
         self.inj_clf.to(self.device)
-        self.acc_clf.to(self.device)
\ No newline at end of file
+        self.acc_clf.to(self.device)
+
+'''
+Convert a model whose attention key and bias are shaped to a fixed batch
+into the batch-agnostic form, where they are shared by the whole batch.
+The per-position keys and biases are averaged, which is the closest single key,
+but the outputs are not exactly the same as before the conversion.
+'''
+def to_shared_attention(model):
+    for module in model.modules():
+        if isinstance(module, Attention) and module.k.shape[0] > 1:
+            module.k = nn.Parameter(module.k.data.mean(0, keepdim=True))
+            module.bias = nn.Parameter(module.bias.data.mean(0, keepdim=True))
+    return model
+
+'''
+In data-parallel training, every process gets batch // world_size samples of the global batch.
+The process rank uses the rows [rank*n, (rank+1)*n) of the key and bias,
+so that the local batches of all processes together see the key and bias as one global batch,
+and the averaged gradient is the one of the global batch.
+rank=None restores the whole key and bias (e.g. for evaluation on full batches).
+A shared key (batch 1) is broadcast, so it is not sharded.
+'''
+def shard_attention(model, rank=None, world_size=1):
+    for module in model.modules():
+        if isinstance(module, Attention) and module.k.shape[0] != 1:
+            n = module.k.shape[0] // world_size
+            module.key_rows = slice(rank*n, (rank+1)*n) if rank is not None else None
+
+
+'''
+Spatially-collapsed fast path of the LVT stages.
+The stages always run on 1x1 feature maps, so every 1x1 conv is a linear layer,
+the 3x3 stride-2 shrink convs only use their centre tap,
+and the final pooling is the identity.
+At inference, the BatchNorm of the values is folded into to_qv,
+and project_out, conv and BatchNorm of each block are folded into one linear layer.
+It is built from an LVT in eval mode, and has to be rebuilt after the weights change.
+'''
+class CollapsedTransformerBlock(nn.Module):
+    def __init__(self, block):
+        super(CollapsedTransformerBlock, self).__init__()
+        attn = block.attn
+        D, H = attn.dim, attn.num_heads
+        c = D // H
+        self.dim = D
+        self.num_heads = H
+        with torch.no_grad():
+            w_q, w_v = attn.to_qv.weight.chunk(2, dim=0)
+            # BatchNorm over heads of the values, (v - mean) / std * gamma + beta
+            scale = attn.bn.weight / torch.sqrt(attn.bn.running_var + attn.bn.eps)
+            shift = attn.bn.bias - attn.bn.running_mean * scale
+            self.register_buffer('w_q', w_q.clone())
+            self.register_buffer('w_v', w_v * scale.repeat_interleave(c).unsqueeze(1))
+            self.register_buffer('b_v', shift.repeat_interleave(c))
+            self.register_buffer('k', attn.k.view(-1, H, c).clone())
+            self.register_buffer('bias', attn.bias.view(-1, H, c, c).clone())
+            self.register_buffer('temperature', attn.temperature.clone())
+
+            # bn(conv(project_out(a))) as a single linear layer
+            w_po = attn.project_out.weight[:, :, 0, 0]
+            b_po = attn.project_out.bias if attn.project_out.bias is not None else torch.zeros(D, device=w_po.device)
+            w_c = block.conv.weight[:, :, 0, 0]
+            b_c = block.conv.bias if block.conv.bias is not None else torch.zeros(D, device=w_c.device)
+            scale = block.bn.weight / torch.sqrt(block.bn.running_var + block.bn.eps)
+            self.register_buffer('w_o', scale.unsqueeze(1) * (w_c @ w_po))
+            self.register_buffer('b_o', scale * (w_c @ b_po + b_c - block.bn.running_mean) + block.bn.bias)
+        self.ffn = block.ffn
+
+    def forward(self, x):
+        B = x.shape[0]
+        q = F.linear(x, self.w_q).view(B, self.num_heads, -1)
+        v = F.linear(x, self.w_v, self.b_v).view(B, self.num_heads, -1)
+
+        k, bias = self.k, self.bias
+        if k.shape[0] != 1 and B != k.shape[0]:
+            k = k.repeat(B // k.shape[0], 1, 1)
+            bias = bias.repeat(B // bias.shape[0], 1, 1, 1)
+
+        attn = q.unsqueeze(-1) * k.unsqueeze(-2)
+        attn = (attn + bias) * self.temperature
+        attn = attn.softmax(dim=-1)
+        out = (attn @ v.unsqueeze(-1)).view(B, self.dim)
+
+        out = F.linear(out, self.w_o, self.b_o) + x
+        return self.ffn(out) + out
+
+class CollapsedStages(nn.Module):
+    def __init__(self, model):
+        super(CollapsedStages, self).__init__()
+        assert not model.training, 'CollapsedStages folds BatchNorm, so the model has to be in eval mode'
+        self.stage1 = nn.Sequential(*[CollapsedTransformerBlock(block) for block in model.stage1])
+        self.stage2 = nn.Sequential(*[CollapsedTransformerBlock(block) for block in model.stage2])
+        self.stage3 = nn.Sequential(*[CollapsedTransformerBlock(block) for block in model.stage3])
+        self.shrink1 = self.centre_tap(model.shrink1)
+        self.shrink2 = self.centre_tap(model.shrink2)
+
+    def centre_tap(self, conv):
+        linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None).to(conv.weight.device)
+        with torch.no_grad():
+            linear.weight.copy_(conv.weight[:, :, 1, 1])
+            if conv.bias is not None:
+                linear.bias.copy_(conv.bias)
+        return linear
+
+    def forward(self, input):
+        out = self.shrink1(self.stage1(input.flatten(1)))
+        out = self.shrink2(self.stage2(out))
+        out = self.stage3(out)
+        return out.view(*out.shape, 1, 1)
+
+'''
+Numerical check of the collapsed stages against LVT.forward_stages.
+Return the maximum absolute difference on the pooled features x, (B, dim, 1, 1),
+and raise a RuntimeError if it is larger than tol (if given).
+The difference is below 1e-6 in float32 (see benchmarks/collapsed_stages.py).
+'''
+COLLAPSED_TOL = 1e-4
+
+def check_collapsed(model, stages, x, tol=None):
+    with torch.no_grad():
+        diff = (model.forward_stages(x) - stages(x)).abs().max().item()
+    if tol is not None and diff > tol:
+        raise RuntimeError(f'collapsed stages differ from the stages by {diff:.3e} > {tol:.0e}')
+    return diff
+
+
+'''
+Checkpoint format.
+The model is saved as state_dicts and metadata instead of a pickled module :
+    version, task, n_class, IL_type, arch (constructor arguments of LVT),
+    model (state_dict), prev_acc_weight (stacked classifiers of previous tasks in Task IL, or None)
+and any extra entries (e.g. the importance of the task).
+It is loaded with a memory map when torch supports it, into a model built on the meta device,
+so no throwaway model is initialized and only the tensors which are used are read.
+'''
+CHECKPOINT_VERSION = 1
+
+def checkpoint_dict(model, task, **extra):
+    checkpoint = {
+        'version': CHECKPOINT_VERSION,
+        'task': task,
+        'n_class': model.n_class,
+        'IL_type': model.IL_type,
+        'arch': model.arch,
+        'model': model.state_dict(),
+        'prev_acc_weight': model.get_prev_acc_weight().cpu() if model.IL_type == 'task' and len(model.prev_acc_clf) > 0 else None,
+    }
+    checkpoint.update(extra)
+    return checkpoint
+
+def save_checkpoint(model, path, task, **extra):
+    torch.save(checkpoint_dict(model, task, **extra), path)
+
+'''
+Load a checkpoint saved by save_checkpoint, or a pickled LVT of the previous format.
+n_heads limits the classifiers of previous tasks which are restored (Task IL).
+Return the model and the checkpoint metadata (None for a pickled LVT).
+'''
+def load_checkpoint(path, device, n_heads=None):
+    try:
+        checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except TypeError:
+        checkpoint = torch.load(path, map_location='cpu')
+    if isinstance(checkpoint, nn.Module):
+        return checkpoint.to(device), None
+    return model_from_checkpoint(checkpoint, device, n_heads)
+
+'''
+Build the model of a checkpoint dict made by checkpoint_dict.
+'''
+def model_from_checkpoint(checkpoint, device, n_heads=None):
+    if checkpoint['version'] > CHECKPOINT_VERSION:
+        raise ValueError(f"checkpoint version {checkpoint['version']} is newer than {CHECKPOINT_VERSION}")
+    state_dict = checkpoint['model']
+    assign = 'assign' in inspect.signature(nn.Module.load_state_dict).parameters and hasattr(torch, 'device') and hasattr(torch.device, '__enter__')
+
+    def build():
+        model = LVT(n_class=checkpoint['n_class'], IL_type=checkpoint['IL_type'], device=device, pretrained=False, **checkpoint['arch'])
+        # the classifiers may have been extended (with bias) by add_classes
+        for name in ['inj_clf', 'acc_clf']:
+            weight = state_dict[name + '.weight']
+            setattr(model, name, torch.nn.Linear(weight.shape[1], weight.shape[0], bias=name + '.bias' in state_dict))
+        return model
+
+    if assign:
+        with torch.device('meta'):
+            model = build()
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model = build()
+        model.load_state_dict(state_dict)
+    model = model.to(device)
+
+    if model.IL_type == 'task' and checkpoint['prev_acc_weight'] is not None:
+        weight = checkpoint['prev_acc_weight'][:n_heads].to(device)
+        for w in weight:
+            clf = torch.nn.Linear(w.shape[1], w.shape[0], bias=False)
+            clf.weight = nn.Parameter(w)
+            model.prev_acc_clf.append(clf)
+        model.prev_acc_weight = weight
+    meta = {key: value for key, value in checkpoint.items() if key not in ['model', 'prev_acc_weight']}
+    return model, meta
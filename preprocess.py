@@ -0,0 +1,68 @@
+import os
+import time
+import numpy as np
+from torch.utils.data import DataLoader
+
+from utils import get_scenario, get_shard_decode_transforms, get_shard_path, get_shard_shape_path, toGreen
+
+'''
+One-time preprocessing for the 224-px datasets (tinyimagenet200, imagenet100).
+Every task of the train / test split is decoded once and written to a uint8 memory-mapped shard
+with its label index, which is then read by utils.ShardDataset during training.
+The images up to SHARD_SIZE (tinyimagenet200) are stored at their native resolution,
+and the larger ones (imagenet100) are resized to a shorter side of SHARD_SIZE, without cropping.
+The images are first appended to a raw file, since their sizes are only known after decoding.
+'''
+def write_shards(dataset_name, data_path, shard_dir, n_split, num_workers, batch_size=256, chunk=1 << 26):
+    os.makedirs(shard_dir, exist_ok=True)
+    for train in [True, False]:
+        scenario = get_scenario(dataset_name, data_path, train, n_split, get_shard_decode_transforms())
+        for task_id in range(n_split):
+            start = time.time()
+            x_path, y_path = get_shard_path(shard_dir, dataset_name, train, n_split, task_id)
+            taskset = scenario[task_id]
+            # the images have different sizes, so they are not collated
+            loader = DataLoader(taskset, batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=list)
+
+            shapes = np.zeros((len(taskset), 2), dtype=np.int32)
+            y_shard = np.zeros(len(taskset), dtype=np.int16)
+            idx = 0
+            with open(x_path + '.raw', 'wb') as f:
+                for batch in loader:
+                    for x, y, _ in batch:
+                        f.write(x.numpy().tobytes())
+                        shapes[idx] = x.shape[1:]
+                        y_shard[idx] = y
+                        idx += 1
+
+            raw = np.memmap(x_path + '.raw', mode='r', dtype=np.uint8)
+            same_size = (shapes == shapes[0]).all()
+            shape = (len(taskset), 3, *map(int, shapes[0])) if same_size else raw.shape
+            x_shard = np.lib.format.open_memmap(x_path, mode='w+', dtype=np.uint8, shape=shape)
+            flat = x_shard.reshape(-1)
+            for i in range(0, len(raw), chunk):
+                flat[i:i+chunk] = raw[i:i+chunk]
+            x_shard.flush()
+            del x_shard, flat, raw
+            os.remove(x_path + '.raw')
+            if same_size:
+                if os.path.exists(get_shard_shape_path(x_path)):
+                    os.remove(get_shard_shape_path(x_path))
+            else:
+                np.save(get_shard_shape_path(x_path), shapes)
+            np.save(y_path, y_shard)
+            print(toGreen(f"{'train' if train else 'test'} task {task_id} : {idx} images -> {x_path} ({time.time()-start:.1f}s)"))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datapath', type = str, default = '/data/nahappy15/imagenet100/', help = 'data path')
+    parser.add_argument('--dataset', type = str, default = 'imagenet100', help = 'tinyimagenet200, imagenet100')
+    parser.add_argument('--shard_dir', type = str, default = '/data/nahappy15/imagenet100_shards/', help = 'output directory of the shards')
+    parser.add_argument('--split', type = int, default = 10, help = 'number of split')
+    parser.add_argument('--num_workers', type = int, default = 8, help = 'number of decoding workers')
+    args, _ = parser.parse_known_args()
+
+    write_shards(args.dataset, args.datapath, args.shard_dir, args.split, args.num_workers)
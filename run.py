@@ -1,5 +1,5 @@
 
-from trainer import Trainer
+from trainer import Trainer, launch_train
 from config import get_config
 
 
@@ -20,11 +20,39 @@ if __name__ == '__main__':
     parser.add_argument('--num_head', type = int, default = 2, help = 'number of attention head')
     parser.add_argument('--hidden_dim', type = int, default = 512, help = 'number of hidden dimension of attention')
     parser.add_argument('--memory_size', type = int, default = 500, help = 'memory buffer size')
+    parser.add_argument('--num_workers', type = int, default = None, help = 'number of data loader workers (default : dataset config)')
+    parser.add_argument('--prefetch_factor', type = int, default = None, help = 'batches prefetched by each data loader worker')
+    parser.add_argument('--no_persistent_workers', action = 'store_true', default = False, help = 're-fork data loader workers every epoch')
+    parser.add_argument('--shard_dir', type = str, default = None, help = 'directory of the pre-decoded uint8 shards (preprocess.py)')
+    parser.add_argument('--augment', type = str, default = 'pil', help = 'pil (per-sample transforms), batch (batched tensor augmentation, cifar100 only)')
+    parser.add_argument('--memory_backend', type = str, default = 'ram', help = 'ram, mmap (disk-backed memory buffer)')
+    parser.add_argument('--memory_cache', type = int, default = 256, help = 'number of cached examplars of mmap memory buffer')
+    parser.add_argument('--fused_replay', action = 'store_true', default = False, help = 'forward current and replay batch together')
+    parser.add_argument('--shared_key', action = 'store_true', default = False, help = 'share the attention key and bias across the batch (any batch size)')
+    parser.add_argument('--eval_batch_size', type = int, default = None, help = 'batch size of evaluation, only with --shared_key')
+    parser.add_argument('--collapse_eval', action = 'store_true', default = False, help = 'evaluate with the collapsed (pure matmul) transformer stages')
+    parser.add_argument('--frozen_backbone', action = 'store_true', default = False, help = 'freeze the backbone and train on its cached features')
+    parser.add_argument('--feature_dir', type = str, default = None, help = 'directory of the cached backbone features (default : log_dir/features)')
+    parser.add_argument('--feature_seed', type = int, default = 1234, help = 'seed of the loaders and of the augmentation of the cached features')
+    parser.add_argument('--replay_sampling', type = str, default = 'uniform', help = 'uniform, class (class-balanced), task (task-balanced)')
+    parser.add_argument('--replay_prefetch', type = int, default = 2, help = 'number of replay batches prepared in background (0 : no thread)')
+    parser.add_argument('--resume', action = 'store_true', default = False, help = 'resume the training of the run resume_time')
+    parser.add_argument('--resume_task', type = int, default = None, help = 'task of the training state to resume from (default : last saved)')
+    parser.add_argument('--resume_time', type = str, default = None, help = 'time stamp of the run to resume')
+    parser.add_argument('--ckpt_interval', type = int, default = None, help = 'epochs between the training state checkpoints (default 0 : never)')
+    parser.add_argument('--bf16', action = 'store_true', default = False, help = 'run the backbone and the transformer stages under bfloat16 autocast')
+    parser.add_argument('--channels_last', action = 'store_true', default = False, help = 'channels_last memory format in the backbone')
+    parser.add_argument('--compile', action = 'store_true', default = False, help = 'compile the features and the losses with torch.compile')
+    parser.add_argument('--profile', action = 'store_true', default = False, help = 'write the per-phase timings of every task next to the log')
+    parser.add_argument('--world_size', type = int, default = 1, help = 'number of data-parallel training processes on cpu (gloo)')
+    parser.add_argument('--dist_port', type = int, default = 29500, help = 'port of the process group of the data-parallel training')
+    parser.add_argument('--test_workers', type = int, default = 1, help = 'number of processes evaluating the checkpoints in test')
     args, _ = parser.parse_known_args()
 
     config = get_config(dataset=args.dataset)
     ## default
     config.test = args.test
+    config.test_workers = args.test_workers
     config.log_dir = args.log_dir
     config.ILtype = args.ILtype
     config.data_path = args.datapath
@@ -36,11 +64,46 @@ if __name__ == '__main__':
     config.rt = args.rt
     config.num_head = args.num_head
     config.hidden_dim = args.hidden_dim
+    config.shared_key = args.shared_key
+    config.eval_batch_size = args.eval_batch_size
     config.memory_size = args.memory_size
+    config.fused_replay = args.fused_replay
+    config.replay_sampling = args.replay_sampling
+    config.replay_prefetch = args.replay_prefetch
+    config.collapse_eval = args.collapse_eval
+    config.frozen_backbone = args.frozen_backbone
+    config.feature_dir = args.feature_dir
+    config.feature_seed = args.feature_seed
+    config.memory_backend = args.memory_backend
+    config.memory_cache = args.memory_cache
+    config.bf16 = args.bf16
+    config.channels_last = args.channels_last
+    config.compile = args.compile
+    config.profile = args.profile
+    config.world_size = args.world_size
+    config.dist_port = args.dist_port
+    config.model_time = None
+    config.resume = args.resume
+    config.resume_task = args.resume_task
+    config.resume_time = args.resume_time
+    if args.ckpt_interval is not None:
+        config.ckpt_interval = args.ckpt_interval
+    ## data pipeline, the dataset config is used unless given
+    if args.num_workers is not None:
+        config.num_workers = args.num_workers
+    if args.prefetch_factor is not None:
+        config.prefetch_factor = args.prefetch_factor
+    if args.no_persistent_workers:
+        config.persistent_workers = False
+    config.shard_dir = args.shard_dir
+    config.augment = args.augment
 
 
-    trainer = Trainer(config)
-    if args.test:
-        trainer.test()
+    if args.world_size > 1 and not args.test:
+        launch_train(config)
     else:
-        trainer.train()
+        trainer = Trainer(config)
+        if args.test:
+            trainer.test()
+        else:
+            trainer.train()
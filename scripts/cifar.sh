@@ -2,7 +2,7 @@
 
 timestamp=$(date +%s)
 
-                        # --resume True \
+                        # --resume \
                         # --resume_task 1 \
                         # --resume_time 20221201_1356 \
 py3clean ./
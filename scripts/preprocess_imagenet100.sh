@@ -0,0 +1,9 @@
+#!/bin/bash
+
+py3clean ./
+python3 -B ../preprocess.py \
+                        --dataset imagenet100 \
+                        --datapath /data/nahappy15/imagenet100/ \
+                        --shard_dir /data/nahappy15/imagenet100_shards/ \
+                        --split 10 \
+                        --num_workers 8 \
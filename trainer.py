@@ -1,6 +1,8 @@
 import time
 import os
+import datetime
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
 import pickle as pkl
@@ -9,8 +11,9 @@ import numpy as np
 import logging
 
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 from models.lvt import *
-from utils import IncrementalDataLoader, confidence_score, MemoryDataset, get_transforms, toRed, toBlue, toGreen
+from utils import IncrementalDataLoader, get_feature_path, get_feature_tag, confidence_score, MemoryDataset, MemmapMemoryDataset, ExemplarSelector, ReplaySampler, AsyncCheckpointWriter, all_reduce_grads, average_buffers, broadcast_model, CompiledFunction, Profiler, get_transforms, get_normalization, scenario_cache_stats, toRed, toBlue, toGreen
     
 
 '''random seed'''
@@ -40,22 +43,97 @@ def init_xavier(submodule):
             init_xavier(sm)
 
 
+'''
+Losses of a training step, as functions of tensors only,
+so that they can be compiled (see Trainer.compile) and the classifiers extended by add_classes
+are new inputs of the same graph instead of new modules.
+'''
+def current_losses(feature, y, inj_weight, inj_bias, acc_weight, acc_bias):
+    feature = feature.flatten(1)
+    inj_logit = nn.functional.linear(feature, inj_weight, inj_bias)
+    acc_logit = nn.functional.linear(feature, acc_weight, acc_bias)
+    return inj_logit, acc_logit, nn.functional.cross_entropy(inj_logit, y), nn.functional.cross_entropy(acc_logit, y)
+
+'''
+L_r and L_d on the replay batch.
+weight is (n_class, dim) for the accumulation classifier (Class IL),
+or (B, n_class, dim) for the stored classifier of the task of every sample (Task IL).
+The distillation is on the first n_old logits (all of them if None).
+'''
+def replay_losses(m_feature, my, z, weight, bias, T, n_old=None, reduction='mean'):
+    m_feature = m_feature.flatten(1)
+    if weight.dim() == 3:
+        acc_logit = torch.bmm(weight, m_feature.unsqueeze(2)).squeeze(2)
+    else:
+        acc_logit = nn.functional.linear(m_feature, weight, bias)
+    L_r = nn.functional.cross_entropy(acc_logit, my, reduction=reduction)
+    L_d = nn.functional.kl_div(nn.functional.log_softmax(z/T, dim=1), nn.functional.softmax(acc_logit[:, :n_old]/T, dim=1), reduction='batchmean')
+    return acc_logit, L_r, L_d
+
+'''
+L_a, the distance of the attention key and bias to those of the previous task, weighted by their importance.
+'''
+def attention_loss(model, K_grad, K_prev, bias_grad, bias_prev):
+    return (torch.abs(torch.tensordot(K_grad, (model.get_K() - K_prev)))).sum() / 32. + \
+            (torch.abs(torch.tensordot(bias_grad, (model.get_bias() - bias_prev), dims=([2, 1], [2, 1])))).sum() / 32.
+
+
 '''
 All training and testing functions are implemented in this class.
 '''
 class Trainer():
-    def __init__(self, config):
+    '''
+    With log=False, no log file is created (e.g. in the test workers).
+    rank is the process of the data-parallel training (see train_worker).
+    '''
+    def __init__(self, config, log=True, rank=0):
+        self.config = config
         self.log_dir = config.log_dir
         self.dataset = config.dataset
         self.train_epoch = config.epoch
         self.batch_size = config.batch_size
+        '''
+        With world_size > 1, the training is data-parallel over world_size processes on cpu.
+        Every process trains on batch_size // world_size samples of each global batch,
+        with a replica of the model and of the memory, and the gradients are averaged.
+        Only the process 0 evaluates, saves and logs.
+        '''
+        self.rank = rank
+        self.world_size = 1 if config.test else config.world_size
+        self.distributed = self.world_size > 1
+        if self.batch_size % self.world_size != 0:
+            raise ValueError(f'batch size {self.batch_size} is not divisible by world size {self.world_size}')
+        self.local_batch_size = self.batch_size // self.world_size
+        '''
+        With shared_key, the attention key and bias are shared across the batch,
+        so any batch size works, the tail batches are kept and evaluation can use a larger batch.
+        '''
+        self.shared_key = config.shared_key
+        self.key_batch = 1 if self.shared_key else self.batch_size
+        self.eval_batch_size = (config.eval_batch_size or self.batch_size) if self.shared_key else self.batch_size
         self.lr = config.lr
         self.split = config.split
         self.memory_size = config.memory_size
+        self.memory_backend = config.memory_backend     # ram, mmap
+        self.memory_cache = config.memory_cache         # number of cached examplars of mmap memory
         self.ILtype = config.ILtype
         self.data_path = config.data_path
         self.scheduler = config.scheduler
-        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.test_workers = config.test_workers     # number of processes evaluating checkpoints in test
+        self.device = torch.device('cuda') if torch.cuda.is_available() and not self.distributed else torch.device('cpu')
+        self.loader_kwargs = dict(
+            num_workers=config.num_workers,
+            pin_memory=config.pin_memory and self.device.type == 'cuda',
+            persistent_workers=config.persistent_workers,
+            prefetch_factor=config.prefetch_factor,
+            shard_dir=config.shard_dir,
+            augment=config.augment,
+            feature_dir=None,
+            seed=config.feature_seed,
+        )
+        self.augment = config.augment
+        if self.augment == 'batch' and self.dataset != 'cifar100':
+            raise ValueError(f'batched augmentation is only supported on cifar100, not {self.dataset}')
         self.act = nn.Softmax(dim=1)
         if self.dataset == 'tinyimagenet200':
             self.n_classes = 200
@@ -63,7 +141,27 @@ class Trainer():
             self.n_classes = 100
         self.increment = int(self.n_classes//self.split)
         self.cur_classes = self.increment
-        self.model_time = time.strftime("%Y%m%d_%H%M%S")
+        '''
+        The training state is saved every ckpt_interval epochs (0 : never), and at the end of every task.
+        With resume, the training of the run resume_time goes on from its last saved state
+        (of the task resume_task if given), and the logs and checkpoints of the run are continued.
+        '''
+        self.ckpt_interval = config.ckpt_interval
+        self.resume = config.resume
+        self.resume_task = config.resume_task
+        if self.resume and config.resume_time is None:
+            raise ValueError('resume_time is required to resume the training')
+        self.model_time = config.resume_time if self.resume else (config.model_time or time.strftime("%Y%m%d_%H%M%S"))
+        self.state_writer = AsyncCheckpointWriter()
+        self.memory_snapshots = set()
+        self.resume_memory = None
+        self.resume_rng = None
+        '''
+        With profile, the phases of every task (training steps, importance pass, memory update, save, eval)
+        are timed, and their summary is written next to the log as {model_time}_task_{task}_profile.json.
+        In data-parallel training, the process 0 is profiled.
+        '''
+        self.profiler = Profiler(config.profile and rank == 0, self.device)
         
         # hyper parameter
         self.num_head = config.num_head             # number of heads in attention 
@@ -73,23 +171,74 @@ class Trainer():
         self.beta = config.beta                     # coefficient of L_d
         self.gamma = config.gamma                   # coefficient of L_a
         self.rt = config.rt                         # coefficient of L_At
+        self.fused_replay = config.fused_replay     # one backbone forward for current and replay batch
+        self.replay_sampling = config.replay_sampling   # uniform, class, task
+        self.replay_prefetch = config.replay_prefetch   # number of replay batches prepared in background
+        self.collapse_eval = config.collapse_eval   # collapsed fast path of the stages in evaluation
+        '''
+        With frozen_backbone, the backbone is not trained, and its pooled features are computed once
+        per task and split, and stored in feature_dir. Then the loaders return the cached features.
+        '''
+        self.frozen_backbone = config.frozen_backbone
+        self.feature_seed = config.feature_seed
+        self.feature_dir = config.feature_dir or os.path.join(os.path.dirname(os.path.realpath(__file__)), self.log_dir, 'features')
         self.T = 2.                                 # softmax temperature, which is used in distillation loss
+        '''
+        With bf16, the backbone and the transformer stages run under bfloat16 autocast,
+        and with channels_last, the backbone convolutions use the channels_last memory format.
+        The features are cast back to float32, so the classifiers, the losses, the confidence score
+        and the L_a term are computed in float32.
+        '''
+        self.bf16 = config.bf16
+        self.channels_last = config.channels_last
+        '''
+        With compile, the features of the trained model (backbone and stages) in the training steps, the losses and L_a
+        are compiled with torch.compile, and fall back to eager mode if it is not possible.
+        The losses take the classifier weights as inputs, with dynamic shapes,
+        so the classifiers extended by add_classes do not recompile them.
+        '''
+        self.compile = config.compile
+        self.current_losses, self.replay_losses, self.attention_loss = current_losses, replay_losses, attention_loss
+        if self.compile:
+            self.compiled_features = CompiledFunction(self.eager_features, 'features')
+            self.current_losses = CompiledFunction(current_losses, 'current_losses', dynamic=True)
+            self.replay_losses = CompiledFunction(replay_losses, 'replay_losses', dynamic=True)
+            self.attention_loss = CompiledFunction(attention_loss, 'attention_loss')
+        
+        if self.frozen_backbone:
+            self.loader_kwargs['feature_dir'] = self.feature_dir
         
         '''
         Create the LVT and initialize the parameters.
+        In test, every model is loaded from the checkpoints (see test_checkpoint),
+        so neither the model nor the optimizer is created.
         '''
-        self.model = LVT(batch=self.batch_size, n_class=self.increment, IL_type=self.ILtype, dim=512, num_heads=self.num_head, hidden_dim=self.hidden_dim, bias=self.bias, device=self.device).to(self.device)
+        self.model = None
         self.prev_model = None
-        self.model.apply(init_xavier)
+        self.optimizer = None
+        if not config.test:
+            self.model = LVT(batch=self.key_batch, n_class=self.increment, IL_type=self.ILtype, dim=512, num_heads=self.num_head, hidden_dim=self.hidden_dim, bias=self.bias, device=self.device).to(self.device)
+            '''
+            In frozen_backbone mode, the pretrained backbone is kept, and only the other modules are initialized.
+            '''
+            if self.frozen_backbone:
+                for name, module in self.model.named_children():
+                    if name != 'backbone':
+                        module.apply(init_xavier)
+                self.model.backbone.requires_grad_(False)
+            else:
+                self.model.apply(init_xavier)
+            self.set_memory_format(self.model)
+            self.optimizer = optim.SGD(self.model.parameters(), lr = self.lr)
+            if self.scheduler:
+                self.lr_scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, self.train_epoch/10, 0.1)
         
         '''
         Since dimension of memory depends on the dimension of input image,
         Initialize them on train phase.
         '''
         self.memory = None
-        self.optimizer = optim.SGD(self.model.parameters(), lr = self.lr)
-        if self.scheduler:
-            self.lr_scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, self.train_epoch/10, 0.1)
+        self.importance = None
         
         '''random seed'''
         seed = 1234
@@ -106,9 +255,10 @@ class Trainer():
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         log_name = f"{self.model_time}.log"
         cur_dir = os.path.dirname(os.path.realpath(__file__))
-        file_handler = logging.FileHandler(os.path.join(cur_dir, self.log_dir, 'logs', log_name))
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+        if log:
+            file_handler = logging.FileHandler(os.path.join(cur_dir, self.log_dir, 'logs', log_name))
+            file_handler.setFormatter(formatter)
+            self.logger.addHandler(file_handler)
         self.logger.info(f'alpha :{self.alpha} | beta : {self.beta} | gamma : {self.gamma} | rt : {self.rt} | num_head : {self.num_head} | hidden_dim : {self.hidden_dim}')
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = False
@@ -125,13 +275,16 @@ class Trainer():
             os.makedirs(os.path.join(cur_dir, self.log_dir,'logs'), exist_ok=True)
             os.makedirs(os.path.join(cur_dir, self.log_dir,'saved_models'), exist_ok=True)
             os.makedirs(os.path.join(cur_dir, self.log_dir,'best_models'), exist_ok=True)
-        file_handler = logging.FileHandler(os.path.join(cur_dir, self.log_dir, 'logs', log_name))
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+        if log:
+            file_handler = logging.FileHandler(os.path.join(cur_dir, self.log_dir, 'logs', log_name))
+            file_handler.setFormatter(formatter)
+            self.logger.addHandler(file_handler)
         self.logger.info(f'alpha :{self.alpha} | beta : {self.beta} | gamma : {self.gamma} | rt : {self.rt} | num_head : {self.num_head} | hidden_dim : {self.hidden_dim} | memory_size : {self.memory_size} | dataset : {self.dataset}')
         
     '''
     Save the model according to the task number.
+    The checkpoint holds the state_dict, the metadata of the model
+    and the importance of the task, so that the next task does not have to compute it again.
     '''
     def save(self, model, task):
         model_name = f"{self.dataset}_model_{self.model_time}_task_{task}.pt"
@@ -139,8 +292,189 @@ class Trainer():
         cur_dir = os.path.dirname(os.path.realpath(__file__))
         print(f'Path : {os.path.join(os.path.join(cur_dir, self.log_dir, "saved_models", model_name))}')
         self.logger.info(f'Model saved as {model_name}')
-        torch.save(model, os.path.join(os.path.join(cur_dir, self.log_dir, "saved_models", model_name)))
+        save_checkpoint(model, os.path.join(os.path.join(cur_dir, self.log_dir, "saved_models", model_name)), task, importance=self.importance)
+
+    '''
+    Path of the training state saved during the task.
+    '''
+    def state_path(self, task):
+        cur_dir = os.path.dirname(os.path.realpath(__file__))
+        return os.path.join(cur_dir, self.log_dir, 'saved_models', f'{self.dataset}_state_{self.model_time}_task_{task}.pt')
+
+    '''
+    Save everything needed to continue the training at the given task and epoch :
+    the model and the previous model, the optimizer and scheduler, the memory, the importance,
+    r(t), and the states of the random generators (of the data loader of the task if given).
+    The state is copied and written on a background thread, so the training goes on meanwhile.
+    The file of the mmap memory is copied next to the state once per task, since it only changes at the end of a task.
+    '''
+    def save_state(self, task, epoch, data_loader=None):
+        files = {}
+        memory = self.memory.state_dict()
+        if isinstance(self.memory, MemmapMemoryDataset):
+            memory['x_path'] = self.state_path(task) + '.memory.npy'
+            if memory['x_path'] not in self.memory_snapshots:
+                files[self.memory.path] = memory['x_path']
+                self.memory_snapshots.add(memory['x_path'])
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'task': task,
+            'epoch': epoch,
+            'model': checkpoint_dict(self.model, task),
+            'prev_model': checkpoint_dict(self.prev_model, task-1) if self.prev_model is not None else None,
+            'optimizer': self.optimizer.state_dict(),
+            'lr_scheduler': self.lr_scheduler.state_dict() if self.scheduler else None,
+            'memory': memory,
+            'importance': self.importance,
+            'rt': self.rt,
+            'cur_classes': self.cur_classes,
+            'loader_rng': data_loader.generator.get_state() if data_loader is not None else None,
+            'rng': {
+                'python': random.getstate(),
+                'numpy': np.random.get_state(),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+        self.state_writer.save(state, self.state_path(task), files)
+
+    '''
+    Load the training state of the run, and return the task and epoch to start from.
+    The memory and the random states are restored in train, after the loader of the task is built.
+    '''
+    def load_state(self):
+        task = self.resume_task
+        if task is None:
+            cur_dir = os.path.dirname(os.path.realpath(__file__))
+            prefix = f'{self.dataset}_state_{self.model_time}_task_'
+            tasks = [int(name[len(prefix):-len('.pt')]) for name in os.listdir(os.path.join(cur_dir, self.log_dir, 'saved_models'))
+                     if name.startswith(prefix) and name.endswith('.pt')]
+            if len(tasks) == 0:
+                raise FileNotFoundError(f'no training state of {self.model_time} in {self.log_dir}')
+            task = max(tasks)
+        try:
+            state = torch.load(self.state_path(task), map_location='cpu', weights_only=False)
+        except TypeError:
+            state = torch.load(self.state_path(task), map_location='cpu')
+        if state['version'] > CHECKPOINT_VERSION:
+            raise ValueError(f"state version {state['version']} is newer than {CHECKPOINT_VERSION}")
+
+        self.model, _ = model_from_checkpoint(state['model'], self.device)
+        self.set_memory_format(self.model)
+        if self.frozen_backbone:
+            self.model.backbone.requires_grad_(False)
+        self.model.train()
+        self.prev_model = None
+        if state['prev_model'] is not None:
+            self.prev_model, _ = model_from_checkpoint(state['prev_model'], self.device)
+            self.set_memory_format(self.prev_model)
+            self.prev_model.eval()
+        self.optimizer = optim.SGD(self.model.parameters(), lr = self.lr)
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler:
+            self.lr_scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, self.train_epoch/10, 0.1)
+            self.lr_scheduler.load_state_dict(state['lr_scheduler'])
+        self.importance = state['importance']
+        self.rt = state['rt']
+        self.cur_classes = state['cur_classes']
+        self.resume_memory = state['memory']
+        if 'x_path' in state['memory']:
+            self.memory_snapshots.add(state['memory']['x_path'])
+        if state['epoch'] > 0:
+            self.resume_rng = (state['loader_rng'], state['rng'])
+        self.logger.info(f"Resumed {self.model_time} at task {state['task']} epoch {state['epoch']}")
+        print(toBlue(f"Resumed {self.model_time} at task {state['task']} epoch {state['epoch']}"))
+        return state['task'], state['epoch']
 
+    '''
+    Log how much time the scenario registry saved in this run.
+    '''
+    def log_scenario_cache(self):
+        stats = scenario_cache_stats()
+        msg = f'Scenario cache | builds : {stats["builds"]} ({stats["build_time"]:.1f}s) | hits : {stats["hits"]} | saved : {stats["saved_time"]:.1f}s'
+        self.logger.info(msg)
+        print(toBlue(msg))
+
+    '''
+    Run forward_acc(forward_backbone(x)) of the model on x in chunks of evaluation batch size,
+    and return the logits on cpu.
+    Unless the attention key is shared, the last chunk is zero padded,
+    since the key is shaped to a fixed batch.
+    '''
+    @torch.no_grad()
+    def forward_chunks(self, model, x):
+        out = []
+        for chunk in range(0, x.shape[0], self.eval_batch_size):
+            x_chunk = x[chunk:chunk+self.eval_batch_size]
+            n_samples = x_chunk.shape[0]
+            if n_samples < self.eval_batch_size and not self.shared_key:
+                zero_pad = torch.zeros((self.eval_batch_size - n_samples, *x_chunk.shape[1:]))
+                x_chunk = torch.concat([x_chunk, zero_pad])
+            x_chunk = x_chunk.to(device=self.device)
+            z = model.forward_acc(self.forward_features(model, x_chunk))
+            out.append(z[:n_samples].detach().cpu())
+        return torch.cat(out)
+
+    '''
+    Features of x given to the transformer stages.
+    x is the pooled backbone feature in frozen_backbone mode, or the image otherwise.
+    Only the training steps of the trained model are compiled.
+    The previous model, the collapsed stages, the importance pass, eval and test run in eager mode,
+    since every switch of train / eval mode or of model would recompile the graph.
+    '''
+    def forward_features(self, model, x, stages=None):
+        if self.compile and model is self.model and model.training and torch.is_grad_enabled() and stages is None:
+            return self.compiled_features(model, x)
+        return self.eager_features(model, x, stages)
+
+    def eager_features(self, model, x, stages=None):
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            if self.frozen_backbone:
+                out = stages(x) if stages is not None else model.forward_stages(x)
+            else:
+                if self.channels_last:
+                    x = x.contiguous(memory_format=torch.channels_last)
+                out = model.forward_backbone(x, stages)
+        return out.float()
+
+    '''
+    With channels_last, convert the weights of the backbone convolutions to the channels_last memory format.
+    '''
+    def set_memory_format(self, model):
+        if self.channels_last:
+            model.backbone.to(memory_format=torch.channels_last)
+
+    '''
+    Compute the pooled features of the frozen backbone on one task once,
+    and store them in feature_dir as float16.
+    The train split is augmented with the loader seed, and the features are keyed by it.
+    '''
+    def cache_features(self, train, task_id):
+        tag = get_feature_tag(self.dataset, train, self.split, task_id, self.loader_kwargs['shard_dir'], self.augment)
+        f_path, y_path = get_feature_path(self.feature_dir, self.dataset, train, self.split, task_id, self.feature_seed, tag)
+        if os.path.exists(f_path):
+            return
+        os.makedirs(self.feature_dir, exist_ok=True)
+        loader_kwargs = dict(self.loader_kwargs, feature_dir=None)
+        data_loader = IncrementalDataLoader(self.dataset, self.data_path, train, self.split, task_id, self.batch_size, get_transforms(self.dataset, not train, augment=self.augment), drop_last=False, **loader_kwargs)
+        backbone = self.model.backbone.eval()
+
+        # the temporary file is per process, in case several processes build the same cache
+        tmp_path = f'{f_path}.{os.getpid()}.tmp'
+        features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=(len(data_loader.dataset), self.model.dim))
+        labels = np.zeros(len(data_loader.dataset), dtype=np.int16)
+        idx = 0
+        with torch.no_grad():
+            for x, y, _ in data_loader:
+                feature = nn.functional.adaptive_avg_pool2d(backbone(x.to(self.device)), (1, 1)).flatten(1)
+                features[idx:idx+x.shape[0]] = feature.cpu().numpy().astype(np.float16)
+                labels[idx:idx+x.shape[0]] = y.numpy()
+                idx += x.shape[0]
+        features.flush()
+        del features
+        np.save(y_path, labels)
+        os.replace(tmp_path, f_path)
+        self.logger.info(f"Cached {idx} backbone features of {'train' if train else 'test'} task {task_id} in {f_path}")
 
     '''
     Core function.
@@ -149,65 +483,103 @@ class Trainer():
     def train(self):
         '''
         We use cross entropy loss for getting classification loss
-        and KL divergence loss to distillate the knowledge of previous task model.
+        and KL divergence loss to distillate the knowledge of previous task model
+        (see current_losses and replay_losses).
         '''
         cross_entropy = nn.CrossEntropyLoss()
-        kl_divergence = nn.KLDivLoss(reduction='batchmean')
 
         self.model.train()
+        start_task, start_epoch = self.load_state() if self.resume else (0, 0)
+        if self.distributed:
+            broadcast_model(self.model)
         '''
         Task starts.
         '''
-        for task in range(self.split):
-            data_loader = IncrementalDataLoader(self.dataset, self.data_path, True, self.split, task, self.batch_size, get_transforms(self.dataset))
+        for task in range(start_task, self.split):
+            if self.frozen_backbone:
+                if self.rank == 0:
+                    with self.profiler.phase('cache_features'):
+                        self.cache_features(True, task)
+                if self.distributed:
+                    dist.barrier()
+            data_loader = IncrementalDataLoader(self.dataset, self.data_path, True, self.split, task, self.local_batch_size, get_transforms(self.dataset, augment=self.augment), drop_last=not self.shared_key,
+                                                num_replicas=self.world_size, rank=self.rank, **self.loader_kwargs)
             # x : (B, 3, 32, 32) | y : (B,) | t : (B,)
-            x = data_loader.dataset[0][0]
+            # collate one sample, so that the batched augmentation is also applied
+            x = data_loader.collate_fn([data_loader.dataset[0]])[0][0]
             K = self.memory_size // (self.increment * (task+1))
 
+            '''
+            When the task is resumed in the middle, the loader and the global random generators
+            continue from their states at the saved epoch.
+            '''
+            if self.resume_rng is not None:
+                loader_rng, rng = self.resume_rng
+                data_loader.generator.set_state(loader_rng)
+                random.setstate(rng['python'])
+                np.random.set_state(rng['numpy'])
+                torch.set_rng_state(rng['torch'])
+                if rng['cuda'] is not None and torch.cuda.is_available():
+                    torch.cuda.set_rng_state_all(rng['cuda'])
+                self.resume_rng = None
+
             '''
             Initialize memory buffer.
             '''
             if self.memory is None:
-                self.memory = MemoryDataset(
-                    torch.zeros(self.memory_size, *x.shape),
-                    torch.zeros(self.memory_size),
-                    torch.zeros(self.memory_size),
-                    torch.zeros(self.memory_size, self.increment),
-                    K
-                )
+                '''
+                Images are stored as uint8, and the cached features of the frozen backbone as float16.
+                A resumed mmap memory reopens its file.
+                '''
+                mean, std = get_normalization(self.dataset)
+                x_dtype, x_np_dtype = torch.uint8, np.uint8
+                if self.frozen_backbone:
+                    mean, std, x_dtype, x_np_dtype = None, None, torch.float16, np.float16
+                if self.memory_backend == 'mmap':
+                    cur_dir = os.path.dirname(os.path.realpath(__file__))
+                    memory_name = f'{self.dataset}_memory_{self.model_time}_rank_{self.rank}.npy' if self.distributed else f'{self.dataset}_memory_{self.model_time}.npy'
+                    self.memory = MemmapMemoryDataset(
+                        os.path.join(cur_dir, self.log_dir, 'memory', memory_name),
+                        (self.memory_size, *x.shape),
+                        torch.zeros(self.memory_size, dtype=torch.int16),
+                        torch.zeros(self.memory_size, dtype=torch.int8),
+                        torch.zeros(self.memory_size, self.increment),
+                        K, mean, std, dtype=x_np_dtype, cache_size=self.memory_cache
+                    )
+                else:
+                    self.memory = MemoryDataset(
+                        torch.zeros(self.memory_size, *x.shape, dtype=x_dtype),
+                        torch.zeros(self.memory_size, dtype=torch.int16),
+                        torch.zeros(self.memory_size, dtype=torch.int8),
+                        torch.zeros(self.memory_size, self.increment),
+                        K, mean, std
+                    )
+                if self.resume_memory is not None:
+                    self.memory.load_state_dict(self.resume_memory)
+                    self.resume_memory = None
 
             
             '''
             In LVT paper, the authors said that the gradient values of key and bias of attention module 
             represents the importance the last task. (equation (2))
-            The average value of gradient is calculated in here.
+            The average value of gradient is collected at the end of the previous task (see below).
             '''
             if task > 0:
-                prev_avg_K_grad = None
-                prev_avg_bias_grad = None
-                length = 0
-                prev_data_loader = IncrementalDataLoader(self.dataset, self.data_path, True, self.split, task-1, self.batch_size, get_transforms(self.dataset))
-                for x, y, _ in prev_data_loader:
-                    length += 1
-                    x = x.to(device=self.device)
-                    y = y.to(device=self.device)
-                    if self.ILtype == 'task':
-                        y = y % self.increment
+                prev_avg_K_grad = self.importance['K_grad'].to(self.device)
+                prev_avg_bias_grad = self.importance['bias_grad'].to(self.device)
+                K_w_prev = self.importance['K'].to(self.device)
+                K_bias_prev = self.importance['bias'].to(self.device)
 
-                    inj_logit = self.prev_model.forward_inj(self.prev_model.forward_backbone(x))
-                    # cross_entropy(inj_logit, y).backward()
-                    if prev_avg_K_grad is not None:
-                        cross_entropy(inj_logit, y).backward()
-                        prev_avg_K_grad += self.prev_model.get_K_grad()
-                        prev_avg_bias_grad += self.prev_model.get_bias_grad()
-                    else:
-                        cross_entropy(inj_logit, y).backward()
-                        prev_avg_K_grad = self.prev_model.get_K_grad()
-                        prev_avg_bias_grad = self.prev_model.get_bias_grad()
-                prev_avg_K_grad /= length
-                prev_avg_bias_grad /= length
-                K_w_prev = self.prev_model.get_K()
-                K_bias_prev = self.prev_model.get_bias()
+                '''
+                In Class IL, the distillation target is the output of the previous model on the memory.
+                Both of them are fixed during the task, so compute it once for the whole buffer.
+                '''
+                if self.ILtype == 'class':
+                    with self.profiler.phase('teacher'):
+                        self.memory.set_teacher(torch.cat([
+                            self.forward_chunks(self.prev_model, self.memory[np.arange(chunk, min(chunk+self.batch_size, self.memory_size))][0])
+                            for chunk in range(0, self.memory_size, self.batch_size)
+                        ]))
 
 
             '''
@@ -218,194 +590,244 @@ class Trainer():
                 train_epoch = 50
             else:
                 train_epoch = self.train_epoch
-            for epoch in range(train_epoch):
-                # Train current Task
-                correct, total = 0, 0
-                correct_m, total_m = 0, 0
-                for batch_idx, (x, y, t) in enumerate(data_loader):
-                    x = x.to(device=self.device)
-                    y = y.to(device=self.device)
-                    if self.ILtype == 'task':
-                        y = y % self.increment
+            with self.profiler.phase('train'):
+                if self.distributed:
+                    shard_attention(self.model, self.rank, self.world_size)
+                for epoch in range(start_epoch if task == start_task else 0, train_epoch):
+                    # Train current Task
+                    correct, total = 0, 0
+                    correct_m, total_m = 0, 0
+                    if self.distributed:
+                        data_loader.sampler.set_epoch(epoch)
+                    if task > 0:
+                        '''
+                        Replay batches of the filled memory slots are prepared on a background thread.
+                        The sampler is seeded per epoch, so a resumed epoch draws the same batches.
+                        Every process of the data-parallel training draws its own replay batches.
+                        '''
+                        replay_seed = (self.feature_seed, task, epoch, self.rank) if self.distributed else (self.feature_seed, task, epoch)
+                        replay = ReplaySampler(self.memory, self.local_batch_size, self.replay_sampling, seed=replay_seed,
+                                               prefetch=self.replay_prefetch, pin_memory=self.device.type == 'cuda')
+                    self.profiler.start()
+                    for batch_idx, (x, y, t) in enumerate(data_loader):
+                        self.profiler.lap('data')
+                        x = x.to(device=self.device, non_blocking=True)
+                        y = y.to(device=self.device, non_blocking=True)
+                        if self.ILtype == 'task':
+                            y = y % self.increment
 
-                    feature = self.model.forward_backbone(x)
-                    inj_logit = self.model.forward_inj(feature)
-                    acc_logit = self.model.forward_acc(feature)
+                        '''
+                        Sample the replay batch from memory buffer.
+                        With fused_replay, the current and replay batches go through one backbone forward.
+                        '''
+                        if task > 0:
+                            memory_idx, (mx,my,mt,z) = replay.next()
 
-                    # if task == 0:
-                    #     acc_logit = torch.zeros_like(inj_logit).to(self.device)
+                            mx = mx.to(self.device, non_blocking=True)
+                            my = my.to(self.device, non_blocking=True)
+                            z = z.to(self.device, non_blocking=True)
+                            self.profiler.lap('replay')
+                            self.profiler.count('replay_images', my.size(0))
 
-                    # print(inj_logit)
-                    '''
-                    L_It and L_At is obtained by the new data.
-                    L_It is cross entropy loss value between output of the
-                    injection classifier and GT value.
-                    L_At is cross entropy loss value between output of the
-                    accumulation classifier and GT value.
-                    '''
-                    L_It = cross_entropy(inj_logit, y)
-                    L_At = cross_entropy(acc_logit, y)
+                        if task > 0 and self.fused_replay:
+                            feature, m_feature = self.forward_features(self.model, torch.cat([x, mx])).split([x.shape[0], mx.shape[0]])
+                        else:
+                            feature = self.forward_features(self.model, x)
+
+                        # if task == 0:
+                        #     acc_logit = torch.zeros_like(inj_logit).to(self.device)
+
+                        # print(inj_logit)
+                        '''
+                        L_It and L_At is obtained by the new data.
+                        L_It is cross entropy loss value between output of the
+                        injection classifier and GT value.
+                        L_At is cross entropy loss value between output of the
+                        accumulation classifier and GT value.
+                        '''
+                        inj_logit, acc_logit, L_It, L_At = self.current_losses(feature, y, self.model.inj_clf.weight, self.model.inj_clf.bias,
+                                                                               self.model.acc_clf.weight, self.model.acc_clf.bias)
                     
-                    # Train memory if task>0
-                    '''
-                    The memory is used after first task.
-                    At the first task, there are nothing in memory.
-                    '''
-                    if task > 0:
-                        # print(f'prev_K_grad : {prev_avg_K_grad.shape}, K : {self.model.get_K().shape}')
-                        # print(f'prev_B_grad : {prev_avg_bias_grad.shape}, B : {self.model.get_bias().shape}')
+                        # Train memory if task>0
                         '''
-                        L_a value can be calculated 
-                        when the previous gradient value exists.
-                        This loss can be regarded as the interation with previous task.
+                        The memory is used after first task.
+                        At the first task, there are nothing in memory.
                         '''
-                        L_a = (torch.abs(torch.tensordot(prev_avg_K_grad, (self.model.get_K() - K_w_prev)))).sum() / 32. + \
-                                (torch.abs(torch.tensordot(prev_avg_bias_grad, (self.model.get_bias() - K_bias_prev), dims=([2, 1], [2, 1])))).sum() / 32.
+                        if task > 0:
+                            # print(f'prev_K_grad : {prev_avg_K_grad.shape}, K : {self.model.get_K().shape}')
+                            # print(f'prev_B_grad : {prev_avg_bias_grad.shape}, B : {self.model.get_bias().shape}')
+                            '''
+                            L_a value can be calculated 
+                            when the previous gradient value exists.
+                            This loss can be regarded as the interation with previous task.
+                            '''
+                            L_a = self.attention_loss(self.model, prev_avg_K_grad, K_w_prev, prev_avg_bias_grad, K_bias_prev)
                         
-                        '''
-                        Calculate the logit value from accumulation classifier on the data in memory buffer.
-                        '''                        
-                        memory_idx = np.random.permutation(self.memory_size)[:self.batch_size]
-                        mx,my,mt,z = self.memory[memory_idx]
-
-                        mx = mx.to(self.device)
-                        my = my.type(torch.LongTensor).to(self.device)
-                        z = z.to(self.device)
-
-                        if self.ILtype=='task':
-                            my = my % self.increment
-                            features = self.model.forward_backbone(mx)
-                            features_prev = self.prev_model.forward_backbone(mx)
-                            L_r = None
-                            
-                            for i in range(self.batch_size):
-                                if L_r is None:
-                                    acc_logit = self.model.forward_acc(features[i,...], int(mt[i].item()))
-                                    # z = self.prev_model.forward_acc(features_prev[i,...], int(mt[i].item())).unsqueeze(0)
-                                    L_r = cross_entropy(acc_logit, my[i,...])
-                                    acc_logit = acc_logit.unsqueeze(0)
-                                else:
-                                    acc_log = self.model.forward_acc(features[i,...], int(mt[i].item()))
-                                    # z_ = self.prev_model.forward_acc(features_prev[i,...], int(mt[i].item()))
-                                    # z = torch.concat([z, z_.unsqueeze(0)], dim=0)
-                                    L_r += cross_entropy(acc_log, my[i,...])
-                                    acc_logit = torch.concat([acc_logit, acc_log.unsqueeze(0)], dim=0)
+                            '''
+                            Calculate the logit value from accumulation classifier on the data in memory buffer.
+                            '''                        
+                            if not self.fused_replay:
+                                m_feature = self.forward_features(self.model, mx)
+
+                            if self.ILtype=='task':
+                                my = my % self.increment
+                                '''
+                                Each replay sample is classified by the stored classifier of its task.
+                                L_r is the sum of the per-sample losses.
+                                '''
+                                acc_logit, L_r, L_d = self.replay_losses(m_feature, my, z, self.model.get_prev_acc_weight()[mt.to(self.device)], None, self.T, reduction='sum')
                                     
-                            _, predicted_m = torch.max(acc_logit, 1)
-                            correct_m += (predicted_m == my).sum().item()
-                            total_m += my.size(0)
+                                _, predicted_m = torch.max(acc_logit, 1)
+                                correct_m += (predicted_m == my).sum().item()
+                                total_m += my.size(0)
                             
-                        else:
-                            acc_logit = self.model.forward_acc(self.model.forward_backbone(mx))
-                            z = self.prev_model.forward_acc(self.prev_model.forward_backbone(mx))
-                            L_r = cross_entropy(acc_logit, my)
-                            _, predicted_m = torch.max(acc_logit, 1)
-                            if epoch == 40:
-                                print(predicted_m)
-                                print(my)
-                            correct_m += (predicted_m == my).sum().item()
-                            total_m += my.size(0)
+                            else:
+                                z = self.memory.get_teacher(memory_idx).to(self.device)
+                                acc_logit, L_r, L_d = self.replay_losses(m_feature, my, z, self.model.acc_clf.weight, self.model.acc_clf.bias, self.T,
+                                                                         self.cur_classes-self.increment)
+                                _, predicted_m = torch.max(acc_logit, 1)
+                                if epoch == 40:
+                                    print(predicted_m)
+                                    print(my)
+                                correct_m += (predicted_m == my).sum().item()
+                                total_m += my.size(0)
                         
-                    '''If first task, then only the losses obtained by new data are backpropagated.
-                    Or, accumulate the losses from memory such as L_r, L_d into L_l'''
-                    if task == 0:
-                        total_loss = L_It + L_At
-                    else:
-                        # L_r = cross_entropy(acc_logit, my)
-                        if self.ILtype == 'class':
-                            L_d = kl_divergence(nn.functional.log_softmax((z/self.T), dim=1), self.act(acc_logit[:,:self.cur_classes-self.increment]/self.T))
+                        '''If first task, then only the losses obtained by new data are backpropagated.
+                        Or, accumulate the losses from memory such as L_r, L_d into L_l'''
+                        if task == 0:
+                            total_loss = L_It + L_At
                         else:
-                            L_d = kl_divergence(nn.functional.log_softmax((z/self.T), dim=1), self.act(acc_logit/self.T))
-                        L_l = self.alpha*L_r + self.beta*L_d + self.rt*L_At
-                        total_loss = L_l + L_It + self.gamma*L_a
+                            # L_r = cross_entropy(acc_logit, my)
+                            L_l = self.alpha*L_r + self.beta*L_d + self.rt*L_At
+                            total_loss = L_l + L_It + self.gamma*L_a
                         
-                    # To log the accuracy, calculate that
-                    _, predicted = torch.max(inj_logit, 1)
-                    correct += (predicted == y).sum().item()
-                    total += y.size(0)
+                        # To log the accuracy, calculate that
+                        _, predicted = torch.max(inj_logit, 1)
+                        correct += (predicted == y).sum().item()
+                        total += y.size(0)
                     
-                    # print(f'batch {batch_idx} | L_l : {L_l}| L_r : {L_r}| L_d : {L_d}| L_At :{L_At}| L_It : {L_It}| L_a : {L_a}| train_loss :{total_loss}|  accuracy : {100*correct/total}')
+                        # print(f'batch {batch_idx} | L_l : {L_l}| L_r : {L_r}| L_d : {L_d}| L_At :{L_At}| L_It : {L_It}| L_a : {L_a}| train_loss :{total_loss}|  accuracy : {100*correct/total}')
+                        self.profiler.lap('forward')
+                        '''
+                        Backward and optimize
+                        '''                    
+                        self.optimizer.zero_grad()
+                        total_loss.backward()
+                        if self.distributed:
+                            all_reduce_grads(self.model)
+                        # if task == 0:
+                        nn.utils.clip_grad_norm_(self.model.parameters(), 5.)
+                        # else:
+                        #     nn.utils.clip_grad_norm_(self.model.parameters(), 10.)
+                        self.optimizer.step()
+                        self.optimizer.zero_grad()
+                        self.profiler.lap('backward')
+                        self.profiler.step()
+                        self.profiler.count('images', y.size(0))
+                        # print(f'batch : {batch_idx} | L : {total_loss} | L_It : {L_It} | L_d :{L_d} | acc : {acc_logit.max()}')
+                    if task > 0:
+                        replay.close()
+                    if self.distributed:
+                        average_buffers(self.model)
+
                     '''
-                    Backward and optimize
-                    '''                    
-                    self.optimizer.zero_grad()
-                    total_loss.backward()
-                    # if task == 0:
-                    nn.utils.clip_grad_norm_(self.model.parameters(), 5.)
-                    # else:
-                    #     nn.utils.clip_grad_norm_(self.model.parameters(), 10.)
-                    self.optimizer.step()
-                    self.optimizer.zero_grad()
-                    # print(f'batch : {batch_idx} | L : {total_loss} | L_It : {L_It} | L_d :{L_d} | acc : {acc_logit.max()}')
-                '''
-                Logging
-                '''
-                if task == 0:
-                    self.logger.info(f'epoch {epoch} | L_At :{L_At:.3f}| L_It : {L_It:.3f}| train_loss :{total_loss:.3f} | accuracy : {100*correct/total:.3f}')
-                    print(f'epoch {epoch} | L_At :{L_At:.3f}| L_It : {L_It:.3f}| train_loss :{total_loss:.3f} |  accuracy : {100*correct/total:.3f}')
-                else:
-                    self.logger.info(f'epoch {epoch} | L_At (acc):{L_At:.3f}| L_It (inj): {L_It:.3f}| L_a (att): {L_a}| L_l (accum): {L_l:.3f}| L_r (replay): {L_r:.3f}| L_d (dark) : {L_d:.3f}|  train_loss :{total_loss:.3f} |  accuracy : {100*correct/total:.3f} | m_accuracy : {100*correct_m/total_m:.3f}')
-                    print(f'epoch {epoch} | L_At (acc):{L_At:.3f}| L_It (inj): {L_It:.3f}| L_a (att): {L_a}| L_l (accum): {L_l:.3f}| L_r (replay): {L_r:.3f}| L_d (dark) : {L_d:.3f}|  train_loss :{total_loss:.3f} |  accuracy : {100*correct/total:.3f} | m_accuracy : {100*correct_m/total_m:.3f}')
+                    Logging
+                    '''
+                    if self.rank == 0 and task == 0:
+                        self.logger.info(f'epoch {epoch} | L_At :{L_At:.3f}| L_It : {L_It:.3f}| train_loss :{total_loss:.3f} | accuracy : {100*correct/total:.3f}')
+                        print(f'epoch {epoch} | L_At :{L_At:.3f}| L_It : {L_It:.3f}| train_loss :{total_loss:.3f} |  accuracy : {100*correct/total:.3f}')
+                    elif self.rank == 0:
+                        self.logger.info(f'epoch {epoch} | L_At (acc):{L_At:.3f}| L_It (inj): {L_It:.3f}| L_a (att): {L_a}| L_l (accum): {L_l:.3f}| L_r (replay): {L_r:.3f}| L_d (dark) : {L_d:.3f}|  train_loss :{total_loss:.3f} |  accuracy : {100*correct/total:.3f} | m_accuracy : {100*correct_m/total_m:.3f}')
+                        print(f'epoch {epoch} | L_At (acc):{L_At:.3f}| L_It (inj): {L_It:.3f}| L_a (att): {L_a}| L_l (accum): {L_l:.3f}| L_r (replay): {L_r:.3f}| L_d (dark) : {L_d:.3f}|  train_loss :{total_loss:.3f} |  accuracy : {100*correct/total:.3f} | m_accuracy : {100*correct_m/total_m:.3f}')
+
+                    if self.rank == 0 and self.ckpt_interval > 0 and (epoch+1) % self.ckpt_interval == 0 and epoch+1 < train_epoch:
+                        with self.profiler.timer('save_state'):
+                            self.save_state(task, epoch+1, data_loader)
             
 
             '''Update memory'''
-            conf_score_list = []
-            x_list = []
-            labels_list = []
+            with self.profiler.phase('importance'):
+                selector = ExemplarSelector(K)
             
-            '''Calculate confidence score'''
-            for x, y, t in data_loader:
-                x_list.append(x)
-                labels_list.append(y)
-                x = x.to(device=self.device)
-                y = y.to(device=self.device)
-                if self.ILtype == 'task':
-                    y = y % self.increment
-                feature = self.model.forward_backbone(x)
-                inj_logit = self.model.forward_inj(feature)
+                '''
+                Calculate confidence score.
+                In the same pass, the average gradient of key and bias of the injection loss is collected,
+                which is the importance of this task used in L_a of the next task.
+                The model is in eval mode, as the previous model was when it was computed at the start of the next task.
+                '''
+                self.model.eval()
+                self.model.zero_grad()
+                avg_K_grad, avg_bias_grad = None, None
+                length = 0
+                for x, y, t in data_loader:
+                    length += 1
+                    labels = y
+                    x_cpu = x
+                    x = x.to(device=self.device)
+                    y = y.to(device=self.device)
+                    if self.ILtype == 'task':
+                        y = y % self.increment
+                    feature = self.forward_features(self.model, x)
+                    inj_logit = self.model.forward_inj(feature)
 
-                conf_score_list.append(confidence_score(inj_logit.detach(), y.detach()).numpy())
-                # store logit z=inj_logit for each x
-            
-            conf_score = np.array(conf_score_list).flatten()
-            labels = torch.cat(labels_list).flatten()
-            xs = torch.cat(x_list).view(-1, *x.shape[1:])
+                    # keep the top K examplars of each class by the confidence score
+                    with self.profiler.timer('exemplar_selection'):
+                        selector.add(x_cpu, labels, confidence_score(inj_logit.detach(), y).cpu())
 
-            '''To add new examplars, reduce examplars to K'''
-            if task > 0:
-                self.memory.remove_examplars(K)
+                    cross_entropy(inj_logit, y).backward()
+                    if avg_K_grad is not None:
+                        avg_K_grad += self.model.get_K_grad()
+                        avg_bias_grad += self.model.get_bias_grad()
+                    else:
+                        avg_K_grad = self.model.get_K_grad()
+                        avg_bias_grad = self.model.get_bias_grad()
 
-            '''Save previous model'''
-            self.prev_model = copy.deepcopy(self.model)
-            self.prev_model.eval()
+                '''
+                In data-parallel training, every process has seen its shard of the task :
+                the importance is averaged, and the examplars are selected among the candidates of all processes.
+                Then the model goes back to the whole key and bias.
+                '''
+                if self.distributed:
+                    for grad in [avg_K_grad, avg_bias_grad]:
+                        dist.all_reduce(grad)
+                        grad /= self.world_size
+                    with self.profiler.timer('exemplar_selection'):
+                        selector.all_gather()
+                    shard_attention(self.model)
+                self.importance = {
+                    'K_grad': (avg_K_grad / length).detach().cpu(),
+                    'bias_grad': (avg_bias_grad / length).detach().cpu(),
+                    'K': self.model.get_K().detach().cpu(),
+                    'bias': self.model.get_bias().detach().cpu(),
+                }
+                self.model.zero_grad()
+                self.model.train()
+            
+            with self.profiler.phase('memory_update'):
+                '''
+                To add new examplars, reduce examplars to K.
+                The file of the mmap memory may still be copied by the last save_state.
+                '''
+                self.state_writer.wait()
+                if task > 0:
+                    self.memory.remove_examplars(K)
 
-            '''Add new examplars'''
-            conf_score_sorted = conf_score.argsort()[::-1]
-            for label in range(self.increment*task, self.increment*(task+1)):
-                new_x = xs[conf_score_sorted[labels==label][:K]]
-                new_y = labels[conf_score_sorted[labels==label][:K]]
-                new_t = torch.full((K,), task).type(torch.LongTensor)
-                new_z = None
-                
-                for chunk in range(0, new_x.shape[0], self.batch_size):
-                    x = new_x[chunk:chunk+self.batch_size]
-                    n_samples = x.shape[0]
-                    if n_samples < 32:
-                        pad_size = self.batch_size - n_samples
-                        zero_pad = torch.zeros((pad_size, *x.shape[1:]))
-                        x = torch.concat([x, zero_pad])
-                    x = x.to(device=self.device)
-                    z = self.prev_model.forward_acc(self.prev_model.forward_backbone(x))
-                    z = z[:n_samples].detach().cpu()
-                    if new_z is None:
-                        new_z = z
-                    else:
-                        new_z = torch.concat([new_z, z], dim=0)
-                # print('x shape : ', new_x.shape)
-                # print('z shape : ', new_z.shape)
-                if self.ILtype == "class":
-                    new_z = new_z[:,-self.increment:]
-                self.memory.update_memory(label, new_x, new_y, new_t, new_z)
+                '''Save previous model'''
+                self.prev_model = copy.deepcopy(self.model)
+                self.prev_model.eval()
+
+                '''
+                Add new examplars.
+                The logits of the previous model are computed for the examplars of all classes in one pass.
+                '''
+                new_xs = [selector.get(label) for label in range(self.increment*task, self.increment*(task+1))]
+                new_zs = self.forward_chunks(self.prev_model, torch.cat(new_xs)).split([new_x.shape[0] for new_x in new_xs])
+                for label, new_x, new_z in zip(range(self.increment*task, self.increment*(task+1)), new_xs, new_zs):
+                    new_y = torch.full((new_x.shape[0],), label).type(torch.LongTensor)
+                    new_t = torch.full((new_x.shape[0],), task).type(torch.LongTensor)
+                    if self.ILtype == "class":
+                        new_z = new_z[:,-self.increment:]
+                    self.memory.update_memory(label, new_x, new_y, new_t, new_z)
                 
             '''updatae r(t)'''
             self.rt *= 0.9
@@ -415,55 +837,93 @@ class Trainer():
             In Task IL, LVT generates new classifier
             and store the currently used classifier.
             In Class IL, LVT extendes the classifiers.
+            In data-parallel training, the new classifiers are initialized from the random generator of every process,
+            which may have been used differently, so they are copied from the process 0.
             '''
             if self.ILtype == 'task':
                 self.model.add_classes(self.increment)
             if self.ILtype == 'class':
                 self.model.add_classes(self.increment)
                 self.cur_classes += self.increment
+            if self.distributed:
+                broadcast_model(self.model)
             
             
             '''Reset optimizer'''
             self.optimizer = optim.SGD(self.model.parameters(), lr = self.lr)
             if self.scheduler:
                 self.lr_scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, self.train_epoch/10, 0.1)
-            
-            '''Save model and memory'''
-            self.save(self.model, task)
-            
-            '''test'''
-            self.eval(task)
+
+            if self.rank == 0:
+                with self.profiler.phase('save'):
+                    '''Save the training state to resume from the next task'''
+                    if self.ckpt_interval > 0 and task+1 < self.split:
+                        self.save_state(task+1, 0)
+                    
+                    '''Save model and memory'''
+                    self.save(self.model, task)
+                
+                '''test'''
+                with self.profiler.phase('eval'):
+                    self.eval(task)
+                self.profiler.dump(os.path.join(os.path.dirname(os.path.realpath(__file__)), self.log_dir, 'logs', f'{self.model_time}_task_{task}_profile.json'),
+                                   task=task, world_size=self.world_size, batch_size=self.batch_size)
+            if self.distributed:
+                dist.barrier()
+        self.state_writer.wait()
+        self.log_scenario_cache()
     
     '''
     In this function, just evaluate the model on whole previous tasks 
     where the model is just after trained with current task data.
+    The test data of all seen tasks are streamed once, and the features are computed once per sample.
+    In Task IL, every sample is classified by the stored classifier of its task in one batched matmul,
+    and in Class IL, by the accumulation classifier masked to the classes seen so far.
+    With verbose=False, the accuracies are returned without being logged and printed (e.g. in the test workers).
     '''
-    def eval(self, task, test=False):
+    def eval(self, task, test=False, verbose=True):
         self.model.eval()
-        acc = []
+        correct = np.zeros(task+1)
+        total = np.zeros(task+1)
         with torch.no_grad():
+            '''
+            With collapse_eval, the transformer stages run on the collapsed fast path,
+            which is checked against the stages on random features first.
+            '''
+            stages = None
+            if self.collapse_eval:
+                stages = CollapsedStages(self.model)
+                check_collapsed(self.model, stages, torch.randn(self.eval_batch_size, self.model.dim, 1, 1, device=self.device), COLLAPSED_TOL)
+            if self.frozen_backbone:
+                for task_id in range(task+1):
+                    self.cache_features(False, task_id)
+            data_loader = IncrementalDataLoader(self.dataset, self.data_path, False, self.split, range(task+1), self.eval_batch_size, get_transforms(self.dataset, True, augment=self.augment), drop_last=False, **self.loader_kwargs)
+            for x, y, t in data_loader:
+                n_samples = x.shape[0]
+                if n_samples < self.eval_batch_size and not self.shared_key:
+                    # the attention key is shaped to a fixed batch
+                    x = torch.concat([x, torch.zeros((self.eval_batch_size - n_samples, *x.shape[1:]))])
+                x = x.to(device=self.device)
+                y = y.to(device=self.device)
+                t = t.to(device=self.device)
+                feature = self.forward_features(self.model, x, stages)[:n_samples]
+                if self.ILtype == 'task':
+                    y = y % self.increment
+                    acc_logit = self.model.forward_acc_multi(feature, t)
+                else:
+                    acc_logit = self.model.forward_acc(feature)[:, :self.increment*(task+1)]
+
+                _, predicted = torch.max(acc_logit, 1)
+                correct += np.bincount(t[predicted == y].cpu().numpy(), minlength=task+1)
+                total += np.bincount(t.cpu().numpy(), minlength=task+1)
+
+        acc = list(100*correct/total)
+        if verbose:
             for task_id in range(task+1):
-                correct, total = 0, 0
-                data_loader = IncrementalDataLoader(self.dataset, self.data_path, False, self.split, task_id, self.batch_size, get_transforms(self.dataset, True))
-                for x, y, t in data_loader:
-                    x = x.to(device=self.device)
-                    y = y.to(device=self.device)
-                    if self.ILtype == 'task':
-                        y = y % self.increment
-                        acc_logit = self.model.forward_acc(self.model.forward_backbone(x), task_id)
-                    else:
-                        acc_logit = self.model.forward_acc(self.model.forward_backbone(x))
-
-                    _, predicted = torch.max(acc_logit, 1)
-                    # print(predicted)
-                    # print(y)
-                    correct += (predicted == y).sum().item()
-                    total += y.size(0)
-                acc.append(100*correct/total)
-                self.logger.info(f'Test accuracy on task {task_id} : {100*correct/total}')
-                print(toGreen(f'Test accuracy on task {task_id} : {100*correct/total}'))
-        self.logger.info(f'Total test accuracy on task {task} : {sum(acc)/len(acc)}')
-        print(toGreen(f'Total test accuracy on task {task} : {sum(acc)/len(acc)}'))
+                self.logger.info(f'Test accuracy on task {task_id} : {acc[task_id]}')
+                print(toGreen(f'Test accuracy on task {task_id} : {acc[task_id]}'))
+            self.logger.info(f'Total test accuracy on task {task} : {sum(acc)/len(acc)}')
+            print(toGreen(f'Total test accuracy on task {task} : {sum(acc)/len(acc)}'))
         self.model.train()
         if test:
             return acc
@@ -477,20 +937,38 @@ class Trainer():
     and it will be evaluated.
     '''
     def test(self):
-        self.model.eval()
         result_acc = np.zeros((self.split, self.split))
-        with torch.no_grad():
+        if self.test_workers > 1:
+            '''
+            The checkpoints are independent, so they are evaluated concurrently in a process pool.
+            The cores are divided between the workers, and the workers do not fork data loader workers.
+            With frozen_backbone, the test features are cached here before the workers start,
+            since the backbone is the same in every checkpoint.
+            The workers only return the accuracies, which are printed here.
+            '''
+            if self.frozen_backbone:
+                self.load_test_model(self.split-1)
+                for task_id in range(self.split):
+                    self.cache_features(False, task_id)
+                self.model = None
+            n_workers = min(self.test_workers, self.split)
+            n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+            worker_config = deepcopy(self.config)
+            worker_config.num_workers = 0
+            ctx = torch.multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=init_test_worker, initargs=(worker_config, n_threads)) as pool:
+                for task_id, task_result in pool.map(test_worker, range(self.split)):
+                    self.logger.info(f'Task {task_id}')
+                    print(toRed(f'----- Task {task_id} -----'))
+                    for i, acc in enumerate(task_result):
+                        self.logger.info(f'Test accuracy on task {i} : {acc}')
+                        print(toGreen(f'Test accuracy on task {i} : {acc}'))
+                    self.logger.info(f'Total test accuracy on task {task_id} : {sum(task_result)/len(task_result)}')
+                    print(toGreen(f'Total test accuracy on task {task_id} : {sum(task_result)/len(task_result)}'))
+                    result_acc[task_id, :task_id+1] = np.array(task_result)
+        else:
             for task_id in range(self.split):
-                '''Load model'''
-                self.model = LVT(batch=self.batch_size, n_class=self.increment*(task_id+1), IL_type=self.ILtype, dim=512, num_heads=self.num_head, hidden_dim=self.hidden_dim, bias=self.bias, device=self.device).to(self.device)
-                cur_dir = os.path.dirname(os.path.realpath(__file__))
-                model_name = f'{self.ILtype}_{self.dataset}_task_{task_id}.pt'
-                self.model = torch.load(os.path.join(os.path.join(cur_dir, self.log_dir, "best_models", model_name)), map_location=self.device)
-                self.model.add_classes(self.increment)
-                '''evaluation for task task_id'''
-                self.logger.info(f'Task {task_id}')
-                print(toRed(f'----- Task {task_id} -----'))
-                task_result = self.eval(task_id, True)
+                task_result = self.test_checkpoint(task_id)
                 result_acc[task_id, :task_id+1] = np.array(task_result)
                 
         avg_forgetting = [0]
@@ -505,4 +983,68 @@ class Trainer():
         self.logger.info(f'Result accuracy for each task : {accuracies}')
         print(toGreen(f'Result accuracy for each task : {accuracies}'))
         self.logger.info(f'Forgetting for each task : {avg_forgetting}')
-        print(toGreen(f'Forgetting for each task : {avg_forgetting}'))
\ No newline at end of file
+        print(toGreen(f'Forgetting for each task : {avg_forgetting}'))
+        self.log_scenario_cache()
+
+    '''
+    Load the checkpoint of task task_id as self.model.
+    Checkpoints of both formats are saved after add_classes, so they already hold a classifier for the next task.
+    The extra add_classes on a pickled LVT of the previous format (meta is None) only reproduces
+    the former test, which also extended the loaded model. It does not change the accuracies,
+    since eval uses the classifiers of the seen tasks only (Task IL) or masks the logits to the seen classes (Class IL).
+    '''
+    def load_test_model(self, task_id):
+        cur_dir = os.path.dirname(os.path.realpath(__file__))
+        model_name = f'{self.ILtype}_{self.dataset}_task_{task_id}.pt'
+        self.model, meta = load_checkpoint(os.path.join(os.path.join(cur_dir, self.log_dir, "best_models", model_name)), self.device, n_heads=task_id+1)
+        if self.shared_key:
+            to_shared_attention(self.model)
+        self.set_memory_format(self.model)
+        if meta is None:
+            with torch.no_grad():
+                self.model.add_classes(self.increment)
+
+    '''
+    Load the checkpoint of task task_id and evaluate it on the tasks seen so far.
+    With verbose=False, nothing is logged or printed, and the accuracies are only returned.
+    '''
+    def test_checkpoint(self, task_id, verbose=True):
+        self.load_test_model(task_id)
+        '''evaluation for task task_id'''
+        if verbose:
+            self.logger.info(f'Task {task_id}')
+            print(toRed(f'----- Task {task_id} -----'))
+        return self.eval(task_id, True, verbose)
+
+
+'''
+Data-parallel training over config.world_size local processes with the gloo backend.
+The processes share the time stamp of the run, and split the cpu cores.
+'''
+def launch_train(config):
+    config.model_time = config.model_time or time.strftime("%Y%m%d_%H%M%S")
+    torch.multiprocessing.spawn(train_worker, args=(config,), nprocs=config.world_size)
+
+def train_worker(rank, config):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{config.dist_port}', rank=rank,
+                            world_size=config.world_size, timeout=datetime.timedelta(hours=2))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // config.world_size))
+    try:
+        Trainer(config, log=rank == 0, rank=rank).train()
+    finally:
+        dist.destroy_process_group()
+
+
+'''
+Process pool workers of Trainer.test.
+Each worker builds its own Trainer once, and evaluates the checkpoints given to it.
+'''
+_test_trainer = None
+
+def init_test_worker(config, n_threads):
+    global _test_trainer
+    torch.set_num_threads(n_threads)
+    _test_trainer = Trainer(config, log=False)
+
+def test_worker(task_id):
+    return task_id, _test_trainer.test_checkpoint(task_id, verbose=False)
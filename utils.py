@@ -1,5 +1,8 @@
 import torch
-from torch.utils.data import DataLoader, Dataset
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Dataset, ConcatDataset, DistributedSampler
+from torch.utils.data.dataloader import default_collate
 import torchvision.transforms as transforms
 from continuum import ClassIncremental
 from continuum.datasets import CIFAR100, TinyImageNet200, ImageNet100
@@ -7,6 +10,14 @@ import random
 import numpy as np
 import termcolor
 import os
+import time
+import heapq
+import queue
+import threading
+import shutil
+import json
+import contextlib
+from collections import OrderedDict
 
 '''random seed'''
 import random
@@ -26,8 +37,23 @@ def toGreen(content):
 def toBlue(content):
     return termcolor.colored(content,"blue",attrs=["bold"])
 
-'''return dataset transforms according to the dataset'''
-def get_transforms(dataset, test=False):
+'''return (mean, std) used to normalize the dataset'''
+def get_normalization(dataset):
+    if dataset == 'cifar100':
+        return (0.5, 0.5, 0.5), (0.5, 0.5, 0.5)
+    else:
+        return (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+
+'''
+return dataset transforms according to the dataset
+With augment='batch' (cifar100 only), only the per-sample conversion to a uint8 tensor is returned,
+and the augmentation is done on the whole batch by BatchAugment.
+'''
+def get_transforms(dataset, test=False, augment='pil'):
+    if augment == 'batch':
+        if dataset != 'cifar100':
+            raise ValueError(f'batched augmentation is only supported on cifar100, not {dataset}')
+        return [transforms.PILToTensor()]
     
     if dataset == 'cifar100':
         transform = [
@@ -63,22 +89,179 @@ def get_transforms(dataset, test=False):
     else:
         return transform_test
 
-'''Using incremental dataset library continuum'''
-def IncrementalDataLoader(dataset_name, data_path, train, n_split, task_id, batch_size, transform):
-    '''random seed'''
-    seed = 1234
-    random.seed(seed)
-    np.random.seed(seed)
-    torch.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
-        
-    if task_id >= n_split:
-        print(f'task id {task_id} > n_split {n_split}')
-        return False
+'''
+Transforms for the pre-decoded uint8 shards (see preprocess.py).
+The uint8 (C, H, W) image is converted back to a PIL image, and the transforms of get_transforms follow,
+so the crops are sampled and resampled exactly as from the JPEG files.
+'''
+SHARD_SIZE = 256
+
+def get_shard_transforms(dataset, test=False):
+    return transforms.Compose([transforms.ToPILImage()] + get_transforms(dataset, test))
+
+'''
+Resize the shorter side of the images larger than size to size, with the aspect ratio kept,
+and keep the smaller images (e.g. the 64-px tinyimagenet200) at their native resolution.
+Since the test transforms start with Resize(256), a test image resized to 256 is not resized again.
+'''
+class ResizeLarger():
+    def __init__(self, size):
+        self.size = size
+        self.resize = transforms.Resize(size)
+
+    def __call__(self, img):
+        if min(img.size) > self.size:
+            return self.resize(img)
+        return img
+
+'''
+Per-sample decoding transforms used when writing the shards.
+Only the large images are resized (to a shorter side of SHARD_SIZE), and nothing is cropped,
+so that the train and test transforms still see the whole image.
+'''
+def get_shard_decode_transforms():
+    return [ResizeLarger(SHARD_SIZE), transforms.PILToTensor()]
+
+'''
+Shards are stored as {dataset}_{train|test}_split{n_split}_task{task_id}_x.npy and the label index as ..._y.npy (int16, (N,)).
+If all the images of a shard have the same size, x is a uint8 (N, 3, H, W) array.
+Otherwise, the images are concatenated in a flat uint8 array, and their (H, W) are stored in ..._shape.npy (int32, (N, 2)).
+'''
+def get_shard_path(shard_dir, dataset_name, train, n_split, task_id):
+    name = f"{dataset_name.lower()}_{'train' if train else 'test'}_split{n_split}_task{task_id}"
+    return os.path.join(shard_dir, name + '_x.npy'), os.path.join(shard_dir, name + '_y.npy')
+
+def get_shard_shape_path(x_path):
+    return x_path[:-len('_x.npy')] + '_shape.npy'
+
+'''
+Dataset reading the uint8 shards through a memory map.
+Images are not copied on access, and are only decoded from JPEG once.
+It returns (x, y, t) in the same way as the continuum TaskSet.
+'''
+class ShardDataset(Dataset):
+    def __init__(self, shard_dir, dataset_name, train, n_split, task_id, transform):
+        x_path, y_path = get_shard_path(shard_dir, dataset_name, train, n_split, task_id)
+        # copy-on-write map, so torch can wrap the pages without copying them
+        self.x = np.load(x_path, mmap_mode='c')
+        self.y = torch.from_numpy(np.load(y_path).astype(np.int64))
+        self.shapes, self.offsets = None, None
+        if os.path.exists(get_shard_shape_path(x_path)):
+            self.shapes = np.load(get_shard_shape_path(x_path))
+            sizes = 3 * self.shapes[:, 0].astype(np.int64) * self.shapes[:, 1]
+            self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.task_id = task_id
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.y)
+
+    def __getitem__(self, idx):
+        if self.shapes is None:
+            x = torch.from_numpy(self.x[idx])
+        else:
+            h, w = self.shapes[idx]
+            x = torch.from_numpy(self.x[self.offsets[idx]:self.offsets[idx+1]].reshape(3, h, w))
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, self.y[idx], self.task_id
+
+'''
+Batched augmentation of cifar100.
+It applies the same augmentation as get_transforms (RandomCrop(32, padding=4), RandomHorizontalFlip, Normalize)
+to a whole uint8 (B, C, H, W) batch at once, with the crop offsets sampled as torchvision, vectorized over the batch.
+The RandomResizedCrop of the 224-px datasets is not batched, since the images have different sizes
+and the PIL resampling (antialiased) can not be matched by grid_sample.
+It is used as the collate_fn of the loader, so it runs in the data loader workers.
+'''
+class BatchAugment():
+    def __init__(self, dataset, test=False, padding=4):
+        if dataset != 'cifar100':
+            raise ValueError(f'batched augmentation is only supported on cifar100, not {dataset}')
+        self.dataset = dataset
+        self.test = test
+        self.padding = padding
+        mean, std = get_normalization(dataset)
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, x):
+        x = x.float().div_(255.)
+        if not self.test:
+            x = self.random_crop(x)
+            x = self.random_flip(x)
+        return (x - self.mean) / self.std
+
+    def collate(self, batch):
+        x, y, t = default_collate(batch)
+        return self(x), y, t
 
+    def random_crop(self, x):
+        B, _, H, W = x.shape
+        x = F.pad(x, (self.padding,)*4)
+        i = torch.randint(0, 2*self.padding+1, (B,))
+        j = torch.randint(0, 2*self.padding+1, (B,))
+        rows = (i.view(B, 1) + torch.arange(H)).view(B, H, 1)
+        cols = (j.view(B, 1) + torch.arange(W)).view(B, 1, W)
+        # (B, H, W, C) -> (B, C, H, W)
+        return x[torch.arange(B).view(B, 1, 1), :, rows, cols].permute(0, 3, 1, 2)
+
+    def random_flip(self, x):
+        flip = torch.rand(x.shape[0]) < 0.5
+        return torch.where(flip.view(-1, 1, 1, 1), x.flip(3), x)
+
+'''
+Pooled backbone features of the frozen backbone, cached per task and split (see Trainer.cache_features).
+The train split is augmented, so the features are also keyed by the seed of the augmentation,
+and by tag, the fingerprint of the backbone and of the input pipeline (see get_feature_tag),
+so that features of another backbone, augmentation or decode path are never reused.
+Features are stored as float16 (N, dim), and the labels as int16 (N,).
+'''
+def get_feature_path(feature_dir, dataset_name, train, n_split, task_id, seed, tag=''):
+    name = f"{dataset_name.lower()}_{'train' if train else 'test'}_split{n_split}_task{task_id}_seed{seed}"
+    if tag:
+        name += f'_{tag}'
+    return os.path.join(feature_dir, name + '_f.npy'), os.path.join(feature_dir, name + '_y.npy')
+
+'''
+Backbone (the pretrained ResNet-18 of torchvision), augmentation and decode path (shards or JPEG files)
+of the features of one task, as cached by Trainer.cache_features.
+'''
+def get_feature_tag(dataset_name, train, n_split, task_id, shard_dir=None, augment='pil', backbone='resnet18in1k'):
+    decode = 'shard' if shard_dir is not None and os.path.exists(get_shard_path(shard_dir, dataset_name, train, n_split, task_id)[0]) else 'jpeg'
+    return f'{backbone}_{augment}_{decode}'
+
+class FeatureDataset(Dataset):
+    def __init__(self, feature_dir, dataset_name, train, n_split, task_id, seed, tag=''):
+        f_path, y_path = get_feature_path(feature_dir, dataset_name, train, n_split, task_id, seed, tag)
+        self.f = np.load(f_path, mmap_mode='c')
+        self.y = torch.from_numpy(np.load(y_path).astype(np.int64))
+        self.task_id = task_id
+
+    def __len__(self):
+        return len(self.y)
+
+    def __getitem__(self, idx):
+        # (dim,) -> (dim, 1, 1), the shape of the pooled backbone output
+        return torch.from_numpy(self.f[idx]).float().view(-1, 1, 1), self.y[idx], self.task_id
+
+'''
+Process-wide registry of incremental scenarios.
+Parsing the dataset and building the ClassIncremental scenario is the expensive part
+of IncrementalDataLoader, so each scenario is built only once per
+(dataset, path, split, train/test, transforms) and only the per-task loaders are created on each call.
+'''
+_scenario_cache = {}
+_scenario_stats = {'builds': 0, 'hits': 0, 'build_time': 0.}
+
+def get_scenario(dataset_name, data_path, train, n_split, transform):
     dataset_name = dataset_name.lower()
+    key = (dataset_name, os.path.abspath(data_path), train, n_split, repr(transform))
+    if key in _scenario_cache:
+        _scenario_stats['hits'] += 1
+        return _scenario_cache[key]
+
+    start = time.time()
     n_classes = 100
     if dataset_name == 'cifar100':
         dataset = CIFAR100(data_path, train=train)
@@ -89,10 +272,107 @@ def IncrementalDataLoader(dataset_name, data_path, train, n_split, task_id, batc
         dataset = ImageNet100(data_path, train=train)
     else:
         print('invalid dataset : ', dataset_name)
-        return False
+        return None
 
     scenario = ClassIncremental(dataset, increment=n_classes//n_split, transformations=transform)
-    loader = DataLoader(scenario[task_id], batch_size = batch_size, shuffle=True, drop_last=True)
+    _scenario_stats['builds'] += 1
+    _scenario_stats['build_time'] += time.time() - start
+    _scenario_cache[key] = scenario
+    return scenario
+
+'''
+Report how often the scenario registry was used.
+saved_time is estimated as (number of cache hits) * (average build time),
+i.e. the time the same run would have spent rebuilding the scenarios.
+'''
+def scenario_cache_stats():
+    builds = _scenario_stats['builds']
+    avg_build_time = _scenario_stats['build_time'] / builds if builds > 0 else 0.
+    return {
+        'builds': builds,
+        'hits': _scenario_stats['hits'],
+        'build_time': _scenario_stats['build_time'],
+        'saved_time': _scenario_stats['hits'] * avg_build_time,
+    }
+
+'''
+Each DataLoader worker gets its own seed derived from the loader generator (base seed + worker id),
+so numpy / random based transforms stay reproducible under the fixed seed.
+'''
+def seed_worker(worker_id):
+    worker_seed = torch.initial_seed() % 2**32
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+
+'''Using incremental dataset library continuum'''
+def IncrementalDataLoader(dataset_name, data_path, train, n_split, task_id, batch_size, transform,
+                          num_workers=0, pin_memory=False, persistent_workers=False, prefetch_factor=2, shard_dir=None, augment='pil', drop_last=True, feature_dir=None, seed=1234,
+                          num_replicas=1, rank=0):
+    '''random seed'''
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+        
+    '''
+    task_id can also be a list (or range) of tasks, then their data are concatenated in one loader.
+    '''
+    task_ids = list(task_id) if isinstance(task_id, (list, tuple, range)) else [task_id]
+    if max(task_ids) >= n_split:
+        print(f'task id {max(task_ids)} > n_split {n_split}')
+        return False
+
+    '''
+    Use the cached backbone features, or the pre-decoded shards if they exist.
+    The batched augmentation is only applied to decoded images.
+    '''
+    decoded = True
+    tasksets = []
+    for task_id in task_ids:
+        feature_tag = get_feature_tag(dataset_name, train, n_split, task_id, shard_dir, augment) if feature_dir is not None else None
+        if feature_dir is not None and os.path.exists(get_feature_path(feature_dir, dataset_name, train, n_split, task_id, seed, feature_tag)[0]):
+            tasksets.append(FeatureDataset(feature_dir, dataset_name, train, n_split, task_id, seed, feature_tag))
+            decoded = False
+        elif shard_dir is not None and os.path.exists(get_shard_path(shard_dir, dataset_name, train, n_split, task_id)[0]):
+            shard_transform = get_shard_transforms(dataset_name.lower(), not train) if augment == 'pil' else None
+            tasksets.append(ShardDataset(shard_dir, dataset_name, train, n_split, task_id, shard_transform))
+        else:
+            scenario = get_scenario(dataset_name, data_path, train, n_split, transform)
+            if scenario is None:
+                return False
+            tasksets.append(scenario[task_id])
+    taskset = tasksets[0] if len(tasksets) == 1 else ConcatDataset(tasksets)
+
+    '''
+    With num_replicas > 1, the loader only yields the shard of the process rank,
+    reshuffled every epoch by sampler.set_epoch. The shards have the same size,
+    so that every process runs the same number of steps.
+    '''
+    sampler = None
+    if num_replicas > 1:
+        sampler = DistributedSampler(taskset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed, drop_last=True)
+
+    '''
+    Without drop_last, a training batch of one sample is still dropped,
+    since BatchNorm can not be trained on it.
+    '''
+    if train and (len(taskset) // num_replicas) % batch_size == 1:
+        drop_last = True
+
+    '''
+    Workers are only forked once per loader when persistent_workers is set,
+    so iterating the same loader over several epochs reuses them.
+    '''
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    collate_fn = BatchAugment(dataset_name.lower(), test=not train).collate if augment == 'batch' and decoded else None
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(worker_init_fn=seed_worker, persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+    loader = DataLoader(taskset, batch_size = batch_size, shuffle=sampler is None, sampler=sampler, drop_last=drop_last,
+                        num_workers=num_workers, pin_memory=pin_memory, generator=generator, collate_fn=collate_fn, **worker_kwargs)
     return loader
 
 '''
@@ -100,11 +380,66 @@ Equation (8) in paper
 Store the examplars considering this confidence score value.
 '''
 def confidence_score(z, c):
-    B = z.shape[0]
-    score = torch.zeros(B)
-    for i in range(B):
-        score[i] = torch.exp(z[i, c[i]]) / (torch.exp(z[i, :])).sum()
-    return score
+    # softmax is computed stably (max subtracted), and the score of the label is gathered
+    return torch.softmax(z.float(), dim=1).gather(1, c.view(-1, 1).long()).squeeze(1)
+
+'''
+Streaming top-K selection of examplars.
+While iterating the loader, it keeps a bounded min-heap of the K candidates
+with the highest confidence score for each class,
+so only about (number of classes) * K images are held instead of the whole task.
+'''
+class ExemplarSelector():
+    def __init__(self, k):
+        self.k = k
+        self.heaps = {}
+        self.count = 0      # tie breaker, so that the images are never compared
+
+    def add(self, x, y, score):
+        for i in range(len(y)):
+            label, s = int(y[i]), float(score[i])
+            heap = self.heaps.setdefault(label, [])
+            if len(heap) < self.k:
+                heapq.heappush(heap, (s, self.count, x[i].clone()))
+            elif s > heap[0][0]:
+                heapq.heapreplace(heap, (s, self.count, x[i].clone()))
+            self.count += 1
+
+    '''
+    return the selected examplars of the label, in descending order of the score.
+    A class may have fewer than K candidates, or none (then an empty batch is returned).
+    '''
+    def get(self, label):
+        items = sorted(self.heaps.get(label, []), key=lambda item: (item[0], item[1]), reverse=True)
+        if len(items) == 0:
+            x = next((heap[0][2] for heap in self.heaps.values() if heap), None)
+            return torch.empty(0) if x is None else x.new_empty((0, *x.shape))
+        return torch.stack([item[2] for item in items])
+
+    '''
+    In data-parallel training, merge the selections of all processes into the global top K of each class.
+    The scores are gathered first, and then only the images of the selected examplars,
+    so every process ends with the same selection.
+    '''
+    def all_gather(self):
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        scores = [(label, s, count) for label, heap in self.heaps.items() for s, count, _ in heap]
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, scores)
+
+        candidates = {}
+        for r, items in enumerate(gathered):
+            for label, s, count in items:
+                candidates.setdefault(label, []).append((s, count*world_size + r, r, count))
+        selected = {label: heapq.nlargest(self.k, items) for label, items in candidates.items()}
+
+        images = {count: x for heap in self.heaps.values() for _, count, x in heap}
+        sent = {count: images[count] for items in selected.values() for _, _, r, count in items if r == rank}
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, sent)
+        self.heaps = {label: [(s, key, gathered[r][count]) for s, key, r, count in items] for label, items in selected.items()}
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
 
 '''
 Memory Buffer
@@ -114,44 +449,499 @@ The size of memory is fixed, therefore have to update the stored values
 considering the size per class.
 In other words, if new class is newly registered to memory buffer,
 then remove before examplars and insert new impressive class data.
+
+If mean and std are given, x is stored as raw uint8 pixels:
+the normalized images are quantized in update_memory,
+and only the sampled items are dequantized and normalized in __getitem__.
+y and t can be stored in compact integer types, and they are returned as long.
 '''
 class MemoryDataset(Dataset):
-    def __init__(self, x, y, t, z, k):
+    def __init__(self, x, y, t, z, k, mean=None, std=None):
         self.x = x
         self.y = y
         self.t = t
         self.z = z
         self.k = k
         self.size = len(self.x)
+        self.mean = torch.tensor(mean).view(-1, 1, 1) if mean is not None else None
+        self.std = torch.tensor(std).view(-1, 1, 1) if std is not None else None
+        self.teacher_z = None
+        self.filled = torch.zeros(self.size, dtype=torch.bool)     # slots which hold an examplar
     
     def __len__(self):
         return self.size
     
     def __getitem__(self, idx):
-        return self.x[idx], self.y[idx], self.t[idx], self.z[idx]
+        return self.decode(self.x[idx]), self.y[idx].long(), self.t[idx].long(), self.z[idx]
 
-    def remove_examplars(self, new_k):
-        new_x = torch.zeros_like(self.x)
-        new_y = torch.zeros_like(self.y)
-        new_t = torch.zeros_like(self.t)
-        new_z = torch.zeros_like(self.z)
+    '''
+    Outputs of the previous model for every slot.
+    They are computed once at the start of a task, since the memory and the previous model
+    do not change during the task, and they are reset when the memory is updated.
+    '''
+    def set_teacher(self, teacher_z):
+        self.teacher_z = teacher_z
 
+    def get_teacher(self, idx):
+        return self.teacher_z[idx]
+
+    def encode(self, x):
+        if self.mean is None:
+            return x
+        return ((x * self.std + self.mean) * 255.).round_().clamp_(0, 255).to(torch.uint8)
+
+    def decode(self, x):
+        if self.mean is None:
+            return x.float()
+        return (x.float() / 255. - self.mean) / self.std
+
+    '''
+    Shrink every class from k to new_k examplars in place.
+    Class i moves from [i*k, i*k+new_k) to [i*new_k, (i+1)*new_k), in increasing order of i,
+    so a block is never overwritten before it is moved.
+    Only a block whose source and destination overlap is copied to a temporary buffer,
+    and the freed tail is zeroed, so no second full-size buffer is allocated.
+    '''
+    def remove_examplars(self, new_k):
+        self.teacher_z = None
+        n_blocks = 0
         for i, start in enumerate(range(0, self.size, self.k)):
             if start+new_k > self.size:
                 break
-            new_x[new_k*i:new_k*(i+1)] = self.x[start:start+new_k]
-            new_y[new_k*i:new_k*(i+1)] = self.y[start:start+new_k]
-            new_t[new_k*i:new_k*(i+1)] = self.t[start:start+new_k]
-            new_z[new_k*i:new_k*(i+1)] = self.z[start:start+new_k]
-
-        self.x = new_x
-        self.y = new_y
-        self.t = new_t.type(torch.LongTensor)
-        self.z = new_z
+            n_blocks = i + 1
+            if start == new_k*i:
+                continue
+            for buf in (self.x, self.y, self.t, self.z, self.filled):
+                src = buf[start:start+new_k]
+                if start < new_k*(i+1):
+                    src = src.clone()
+                buf[new_k*i:new_k*(i+1)] = src
+
+        for buf in (self.x, self.y, self.t, self.z, self.filled):
+            buf[new_k*n_blocks:] = 0
         self.k = new_k
     
+    '''
+    Store the examplars of the label in its block of k slots.
+    A class may have fewer than k examplars, then only the first len(new_x) slots are filled.
+    '''
+    def update_memory(self, label, new_x, new_y, new_t, new_z):
+        self.teacher_z = None
+        n = len(new_x)
+        if n == 0:
+            return
+        start = label*self.k
+        self.x[start:start+n,...] = self.encode(new_x)
+        self.y[start:start+n] = new_y
+        self.t[start:start+n] = new_t
+        self.z[start:start+n,...] = new_z
+        self.filled[start:start+n] = True
+
+    '''
+    State of the buffer for resuming the training.
+    The teacher outputs are not saved, since they are recomputed at the start of a task.
+    '''
+    def state_dict(self):
+        return {'x': self.x, 'y': self.y, 't': self.t, 'z': self.z, 'k': self.k, 'filled': self.filled}
+
+    def load_state_dict(self, state):
+        self.teacher_z = None
+        for name in ['x', 'y', 't', 'z', 'filled']:
+            if name in state:
+                getattr(self, name).copy_(state[name])
+        self.k = state['k']
+
+'''
+Disk-backed Memory Buffer
+Same interface as MemoryDataset, but x lives in a memory-mapped .npy file,
+so the exemplar budget is not bounded by the process RAM.
+A small LRU cache keeps the most recently sampled examplars,
+and the missing ones of a replay batch are read with one sorted gather.
+'''
+class MemmapMemoryDataset(MemoryDataset):
+    def __init__(self, path, shape, y, t, z, k, mean=None, std=None, dtype=np.uint8, cache_size=256):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.x_map = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        super(MemmapMemoryDataset, self).__init__(torch.from_numpy(self.x_map), y, t, z, k, mean, std)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return tuple(item[0] for item in self[[idx]])
+        idx = np.asarray(idx)
+
+        misses = np.unique([i for i in idx.tolist() if i not in self.cache])
+        if len(misses) > 0:
+            rows = self.x[torch.from_numpy(misses)]
+            for i, row in zip(misses.tolist(), rows):
+                self.cache[i] = row
+        for i in idx.tolist():
+            self.cache.move_to_end(i)
+        while len(self.cache) > max(self.cache_size, len(idx)):
+            self.cache.popitem(last=False)
+
+        x = torch.stack([self.cache[i] for i in idx.tolist()])
+        return self.decode(x), self.y[idx].long(), self.t[idx].long(), self.z[idx]
+
+    def remove_examplars(self, new_k):
+        self.cache.clear()
+        super(MemmapMemoryDataset, self).remove_examplars(new_k)
+
     def update_memory(self, label, new_x, new_y, new_t, new_z):
-        self.x[label*self.k:(label+1)*self.k,...] = new_x
-        self.y[label*self.k:(label+1)*self.k] = new_y
-        self.t[label*self.k:(label+1)*self.k] = new_t
-        self.z[label*self.k:(label+1)*self.k,...] = new_z
\ No newline at end of file
+        self.cache.clear()
+        super(MemmapMemoryDataset, self).update_memory(label, new_x, new_y, new_t, new_z)
+
+    '''
+    x is not copied into the state : it is flushed to the file, and a copy of the file is saved with the state
+    (see Trainer.save_state), whose path is state['x_path'] when it is loaded.
+    '''
+    def state_dict(self):
+        self.x_map.flush()
+        state = super(MemmapMemoryDataset, self).state_dict()
+        del state['x']
+        return state
+
+    def load_state_dict(self, state, chunk=1024):
+        self.cache.clear()
+        super(MemmapMemoryDataset, self).load_state_dict(state)
+        x = np.load(state['x_path'], mmap_mode='r')
+        for start in range(0, len(x), chunk):
+            self.x_map[start:start+chunk] = x[start:start+chunk]
+        self.x_map.flush()
+
+'''
+Replay sampler of the memory buffer.
+It only samples the filled slots, and the cost of a draw is O(batch) :
+    uniform : slots without replacement, by rejection of the duplicated draws
+    class   : a class uniformly, then a slot of the class (class-balanced)
+    task    : a task uniformly, then a slot of the task (task-balanced)
+With prefetch > 0, the next replay batches are gathered (and pinned) on a background thread
+while the current step runs. The memory must not be updated while the sampler is open.
+An error of the background thread stops it, and is raised by the next call of next().
+next() returns (slot indices, (x, y, t, z)).
+'''
+class ReplaySampler():
+    def __init__(self, memory, batch_size, mode='uniform', seed=1234, prefetch=2, pin_memory=False):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.mode = mode
+        self.pin_memory = pin_memory
+        self.rng = np.random.default_rng(seed)
+
+        self.slots = memory.filled.nonzero().flatten().numpy()
+        if mode == 'class' or mode == 'task':
+            keys = (memory.y if mode == 'class' else memory.t)[self.slots].numpy()
+            order = np.argsort(keys, kind='stable')
+            self.slots = self.slots[order]
+            _, self.group_start, self.group_size = np.unique(keys[order], return_index=True, return_counts=True)
+        elif mode != 'uniform':
+            raise ValueError(f'invalid replay sampling : {mode}')
+
+        self.queue = None
+        if prefetch > 0:
+            self.queue = queue.Queue(maxsize=prefetch)
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=self.produce, daemon=True)
+            self.thread.start()
+
+    def sample_idx(self):
+        n = len(self.slots)
+        if self.mode == 'uniform':
+            if n <= self.batch_size:
+                return self.slots[self.rng.integers(0, n, self.batch_size)]
+            picked = {}
+            while len(picked) < self.batch_size:
+                for i in self.rng.integers(0, n, self.batch_size - len(picked)).tolist():
+                    picked[i] = None
+            return self.slots[list(picked)]
+        group = self.rng.integers(0, len(self.group_start), self.batch_size)
+        offset = (self.rng.random(self.batch_size) * self.group_size[group]).astype(np.int64)
+        return self.slots[self.group_start[group] + offset]
+
+    def sample(self):
+        idx = self.sample_idx()
+        batch = self.memory[idx]
+        if self.pin_memory:
+            batch = tuple(item.pin_memory() for item in batch)
+        return idx, batch
+
+    def produce(self):
+        while not self.stop.is_set():
+            try:
+                item = self.sample()
+            except Exception as e:
+                item = e
+            while not self.stop.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(item, Exception):
+                return
+
+    def next(self):
+        if self.queue is None:
+            return self.sample()
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        if self.queue is not None:
+            self.stop.set()
+            self.thread.join()
+            self.queue = None
+
+'''
+Copy every tensor of a (nested) state to a new cpu tensor,
+so that the training can go on while the copy is written.
+'''
+def snapshot_state(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot_state(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(value) for value in state)
+    return state
+
+'''
+Checkpoint writer on a background thread.
+save() takes a snapshot of the state and returns, and the snapshot is serialized to a temporary file
+which replaces path when it is complete, so a crash never leaves a partial checkpoint.
+files ({source: destination}) are copied the same way before the state,
+so the files must not be modified until wait() returns.
+At most one write is in flight : save() waits for the previous one.
+'''
+class AsyncCheckpointWriter():
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, state, path, files=None):
+        self.wait()
+        state = snapshot_state(state)
+        self.thread = threading.Thread(target=self.write, args=(state, path, files or {}), daemon=True)
+        self.thread.start()
+
+    def write(self, state, path, files):
+        try:
+            for src, dst in files.items():
+                shutil.copyfile(src, dst + '.tmp')
+                os.replace(dst + '.tmp', dst)
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+'''
+Data-parallel helpers for the process group of torch.distributed.
+The gradients are averaged with one all-reduce of a flattened buffer instead of one per parameter.
+A parameter without gradient contributes zeros, so every process reduces the same buffer.
+'''
+def all_reduce_grads(model):
+    params = [p for p in model.parameters() if p.requires_grad]
+    if len(params) == 0:
+        return
+    flat = torch.cat([(p.grad if p.grad is not None else torch.zeros_like(p)).flatten() for p in params])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for p in params:
+        n = p.numel()
+        p.grad = flat[offset:offset+n].view_as(p)
+        offset += n
+
+'''Average the floating point buffers (BatchNorm statistics), which every process updates on its own shard.'''
+def average_buffers(model):
+    buffers = [b for b in model.buffers() if b.is_floating_point()]
+    if len(buffers) == 0:
+        return
+    flat = torch.cat([b.flatten() for b in buffers])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for b in buffers:
+        b.copy_(flat[offset:offset+b.numel()].view_as(b))
+        offset += b.numel()
+
+'''Copy the parameters and buffers of the process src to every process.'''
+def broadcast_model(model, src=0):
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, src)
+
+'''
+fn compiled with torch.compile, which falls back to the eager fn
+when torch.compile is not available, or when the compilation fails (e.g. no compiler toolchain).
+Only the errors of the compiler (dynamo and its backends) cause the fallback,
+the other errors of fn are raised as in eager mode.
+The compilation is lazy, so the first call of every new input signature is slow (cold),
+and the next calls reuse the compiled graph (warm).
+'''
+class CompiledFunction():
+    def __init__(self, fn, name, **kwargs):
+        self.fn = fn
+        self.name = name
+        self.compiled = None
+        self.errors = ()
+        if hasattr(torch, 'compile'):
+            from torch._dynamo.exc import BackendCompilerFailed, Unsupported
+            self.errors = (BackendCompilerFailed, Unsupported)
+            self.compiled = torch.compile(fn, **kwargs)
+        else:
+            print(toRed(f'torch.compile is not available, {name} runs in eager mode'))
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except self.errors as e:
+                print(toRed(f'compilation of {self.name} failed, it runs in eager mode : {e}'))
+                self.compiled = None
+        return self.fn(*args, **kwargs)
+
+'''
+Peak resident set size of the process in MB.
+On Linux, it is VmHWM, which reset_peak_rss resets, so the peak of a phase can be measured.
+Elsewhere, it is the peak of the whole process.
+'''
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+'''
+Instrumentation of the training loop.
+    phase(name)  : context of a coarse phase (train, eval, save, ...), with its wall time
+                   and the peak RSS during it. Phases are not nested.
+    timer(name)  : context of a fine timer inside a phase.
+    start(), lap(name), step() : per-step timers without context.
+                   lap records the time since the last lap (or start), step the time since the last step,
+                   so the step latency includes the wait for the batch.
+    count(name, n) : counter, e.g. the number of images.
+dump writes the latencies (total, mean, percentiles), the peak RSS, the counters
+and their rates over a phase as JSON, and resets everything.
+When disabled, the methods return at once (and the contexts are one shared nullcontext),
+so the instrumented loop runs at the same speed.
+'''
+class Profiler():
+    def __init__(self, enabled=False, device=None):
+        self.enabled = enabled
+        self.sync = enabled and device is not None and device.type == 'cuda'
+        self.null = contextlib.nullcontext()
+        self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.peak_rss = {}
+        self.counters = {}
+        self.last = self.step_start = time.perf_counter()
+
+    def now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def record(self, name, elapsed):
+        self.times.setdefault(name, []).append(elapsed)
+
+    def phase(self, name):
+        if not self.enabled:
+            return self.null
+        return ProfilerTimer(self, name, rss=True)
+
+    def timer(self, name):
+        if not self.enabled:
+            return self.null
+        return ProfilerTimer(self, name)
+
+    def start(self):
+        if self.enabled:
+            self.last = self.step_start = self.now()
+
+    def lap(self, name):
+        if self.enabled:
+            now = self.now()
+            self.record(name, now - self.last)
+            self.last = now
+
+    def step(self, name='step'):
+        if self.enabled:
+            now = self.now()
+            self.record(name, now - self.step_start)
+            self.last = self.step_start = now
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self, rate_phase='train'):
+        timers = {}
+        for name, times in self.times.items():
+            times = np.array(times) * 1000.
+            timers[name] = {
+                'count': len(times),
+                'total_s': float(times.sum() / 1000.),
+                'mean_ms': float(times.mean()),
+                'p50_ms': float(np.percentile(times, 50)),
+                'p90_ms': float(np.percentile(times, 90)),
+                'p99_ms': float(np.percentile(times, 99)),
+                'max_ms': float(times.max()),
+            }
+            if name in self.peak_rss:
+                timers[name]['peak_rss_mb'] = self.peak_rss[name]
+        rates = {}
+        if rate_phase in self.times:
+            total = sum(self.times[rate_phase])
+            rates = {f'{name}_per_sec': n / total for name, n in self.counters.items() if total > 0}
+        return {'timers': timers, 'counters': dict(self.counters), 'rates': rates}
+
+    def dump(self, path, **extra):
+        if not self.enabled:
+            return
+        with open(path, 'w') as f:
+            json.dump(dict(extra, **self.summary()), f, indent=2)
+        self.reset()
+
+class ProfilerTimer():
+    def __init__(self, profiler, name, rss=False):
+        self.profiler = profiler
+        self.name = name
+        self.rss = rss
+
+    def __enter__(self):
+        if self.rss:
+            reset_peak_rss()
+        self.start = self.profiler.now()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.profiler.now() - self.start)
+        if self.rss:
+            self.profiler.peak_rss[self.name] = max(self.profiler.peak_rss.get(self.name, 0.), peak_rss_mb())
+        return False